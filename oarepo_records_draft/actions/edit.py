@@ -4,6 +4,7 @@ from invenio_db import db
 from invenio_records_rest.views import need_record_permission, pass_record
 from invenio_search import current_search_client
 
+from oarepo_records_draft.actions.idempotency import idempotent
 from oarepo_records_draft.proxies import current_drafts
 from oarepo_records_draft.types import RecordEndpointConfiguration, RecordContext
 
@@ -17,6 +18,7 @@ class EditRecordAction(MethodView):
         super().__init__(**kwargs)
         self.endpoint = endpoint
 
+    @idempotent
     @pass_record
     @need_record_permission('edit_permission_factory')
     def post(self, pid, record, **kwargs):
@@ -10,6 +10,7 @@ from webargs.flaskparser import use_kwargs
 from werkzeug.utils import import_string
 
 from oarepo_records_draft import current_drafts
+from oarepo_records_draft.indexing import IndexingOperations, REFRESH_NONE
 from oarepo_records_draft.types import RecordEndpointConfiguration
 
 # import logging
@@ -103,10 +104,18 @@ try:
 
         return permission_builder
 
-    def index_record(record):
-        indexer = current_drafts.indexer_for_record(record)
-        if indexer:
-            indexer.index(record)
+    def index_record(record, operations: IndexingOperations):
+        """
+        Schedules indexing of the record, called within the transaction that modifies the record.
+        The operation is written to the indexing outbox (or passed to the request's indexing queue)
+        in this transaction, otherwise it is sent when the caller executes ``operations``
+        after the transaction has been committed.
+        """
+        operations.index(record)
+        operations.prepare()
+
+    def indexing_operations():
+        return IndexingOperations(refresh_policy=REFRESH_NONE)
 
     @contextlib.contextmanager
     def locked_record(record):
@@ -146,15 +155,20 @@ try:
         @need_file_permission('put_file_factory', missing_ok=True)
         def put(self, pid, record, key):
 
-            return create_record_file(pid, record,
-                                      key, request.stream,
-                                      request.mimetype,
-                                      {}, self.endpoint_code)
+            operations = indexing_operations()
+            ret = create_record_file(pid, record,
+                                     key, request.stream,
+                                     request.mimetype,
+                                     {}, self.endpoint_code, operations)
+            db.session.commit()
+            operations.execute()
+            return ret
 
         @pass_record
         @need_file_permission('put_file_factory', missing_ok=True)
         def post(self, pid, record, key):
             # lock record row
+            operations = indexing_operations()
             with locked_record(record) as record:
                 files = record.files
                 file_rec = files[key]
@@ -172,16 +186,18 @@ try:
                 file_metadata_modified_before_commit.send(record, record=record, file=file_rec, pid=pid, files=files,
                                                           metadata=metadata)
                 record.commit()
+                index_record(record, operations)
             db.session.commit()
+            operations.execute()
             file_after_metadata_modified.send(record, record=record, file=file_rec, pid=pid, files=files,
                                               metadata=metadata)
-            index_record(record)
             return jsonify(record.files[key].dumps())
 
         @pass_record
         @need_file_permission('delete_file_factory')
         def delete(self, pid, record, key):
             # lock record row
+            operations = indexing_operations()
             with locked_record(record) as record:
                 files = record.files
                 deleted_record = files[key]
@@ -192,9 +208,10 @@ try:
                 files.flush()
                 file_deleted_before_commit.send(record, record=record, files=files, file=deleted_record, pid=pid)
                 record.commit()
+                index_record(record, operations)
 
             db.session.commit()
-            index_record(record)
+            operations.execute()
             rest_file_deleted.send(deleted_record_version)
             file_deleted.send(deleted_record_version, record=record, files=files, file=deleted_record, pid=pid)
             ret = jsonify(deleted_record.dumps())
@@ -251,6 +268,7 @@ try:
         @need_file_permission('put_file_factory', missing_ok=True)
         def post(self, pid: PersistentIdentifier, record, key, multipart=False, multipart_content_type=None):
             # lock record row
+            operations = indexing_operations()
             try:
                 with locked_record(record) as record:
                     stream = None
@@ -281,15 +299,17 @@ try:
                                              key, stream,
                                              content_type,
                                              props,
-                                             self.endpoint_code)
+                                             self.endpoint_code,
+                                             operations)
                     db.session.commit()
                     # log.error('Committed record %s:%s', record.id, record.model.version_id)
+                operations.execute()
                 return ret
             except Exception as e:
                 # log.exception('Caught exception')
                 return make_response(jsonify(status=500, message=str(e)), 500)
 
-    def create_record_file(pid, record, key, stream, content_type, props, endpoint_code):
+    def create_record_file(pid, record, key, stream, content_type, props, endpoint_code, operations):
 
         files = record.files
         file_before_uploaded.send(record, record=record, key=key, files=files, pid=pid)
@@ -321,7 +341,7 @@ try:
         files.flush()
         file_uploaded_before_commit.send(record, record=record, file=record.files[key], files=files, pid=pid)
         record.commit()
-        index_record(record)
+        index_record(record, operations)
         version = record.files[key].get_version()
         rest_file_uploaded.send(version)
         file_uploaded.send(version, record=record, file=files[key], files=files, pid=pid)
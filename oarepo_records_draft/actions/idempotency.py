@@ -0,0 +1,138 @@
+import datetime
+import functools
+import hashlib
+
+from flask import request, current_app, jsonify, make_response
+from flask_login import current_user
+from invenio_db import db
+from sqlalchemy.exc import IntegrityError
+
+from oarepo_records_draft.models import DraftIdempotencyKey
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+
+stored_headers = ('Location', 'Content-Type')
+
+
+def idempotent(f):
+    """
+    Decorator of draft action views. If the request contains ``Idempotency-Key`` header,
+    the response is stored and returned to repeated requests with the same key (same action url
+    and user) instead of performing the action again. A repeated request arriving while
+    the first one is still being processed gets 409 Conflict, unless the first one has not finished
+    within ``OAREPO_DRAFT_IDEMPOTENCY_KEY_LEASE`` (then it is considered abandoned and the action
+    is performed again). Reusing the key with a different query string or body gets 422.
+
+    Responses with 5xx status code (and exceptions) are not stored, so the request can be retried.
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if not key:
+            return f(*args, **kwargs)
+
+        ident = dict(key=key[:255], path=request.path[:255], user_id=str(current_user.get_id() or ''))
+        request_hash = hashlib.sha256(request.query_string + b'\n' + request.get_data()).hexdigest()
+        entry = DraftIdempotencyKey.query.filter_by(**ident).one_or_none()
+        if entry is not None:
+            response = existing_key_response(entry, request_hash)
+            if response is not None:
+                return response
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(DraftIdempotencyKey(request_hash=request_hash, **ident))
+            db.session.commit()
+        except IntegrityError:
+            # the same request has just been started in parallel
+            return in_progress_response()
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            DraftIdempotencyKey.query.filter_by(**ident).delete()
+            db.session.commit()
+            raise
+
+        if response.status_code >= 500:
+            DraftIdempotencyKey.query.filter_by(**ident).delete()
+        else:
+            DraftIdempotencyKey.query.filter_by(**ident).update({
+                DraftIdempotencyKey.status_code: response.status_code,
+                DraftIdempotencyKey.response: response.get_data(as_text=True),
+                DraftIdempotencyKey.headers: {
+                    k: response.headers[k] for k in stored_headers if k in response.headers
+                }
+            })
+        db.session.commit()
+        return response
+
+    return wrapper
+
+
+def existing_key_response(entry: DraftIdempotencyKey, request_hash):
+    """
+    Returns the response to a request with an already used key or None if the action should be performed
+    (the stored entry has expired or has been abandoned by a process that has been killed).
+    """
+    now = datetime.datetime.utcnow()
+    ttl = datetime.timedelta(seconds=current_app.config['OAREPO_DRAFT_IDEMPOTENCY_KEY_TTL'])
+    lease = datetime.timedelta(seconds=current_app.config['OAREPO_DRAFT_IDEMPOTENCY_KEY_LEASE'])
+    if entry.created < now - ttl or (entry.status_code is None and entry.created < now - lease):
+        db.session.delete(entry)
+        db.session.commit()
+        return None
+    if entry.request_hash != request_hash:
+        return mismatch_response()
+    if entry.status_code is None:
+        return in_progress_response()
+    return stored_response(entry)
+
+
+def purge_idempotency_keys(batch_size=1000):
+    """
+    Removes stored responses older than ``OAREPO_DRAFT_IDEMPOTENCY_KEY_TTL``, in batches of ``batch_size``
+    rows (each in its own transaction).
+
+    :return: number of removed keys
+    """
+    expired = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=current_app.config['OAREPO_DRAFT_IDEMPOTENCY_KEY_TTL'])
+    removed = 0
+    while True:
+        batch = DraftIdempotencyKey.query.with_entities(
+            DraftIdempotencyKey.key, DraftIdempotencyKey.path, DraftIdempotencyKey.user_id
+        ).filter(DraftIdempotencyKey.created < expired).limit(batch_size).all()
+        for key, path, user_id in batch:
+            DraftIdempotencyKey.query.filter_by(key=key, path=path, user_id=user_id).delete()
+        db.session.commit()
+        removed += len(batch)
+        if len(batch) < batch_size:
+            return removed
+
+
+def in_progress_response():
+    response = jsonify({
+        "status": "error",
+        "message": "A request with the same Idempotency-Key is being processed"
+    })
+    response.status_code = 409
+    return response
+
+
+def mismatch_response():
+    response = jsonify({
+        "status": "error",
+        "message": "The Idempotency-Key has already been used with a different request"
+    })
+    response.status_code = 422
+    return response
+
+
+def stored_response(entry: DraftIdempotencyKey):
+    response = make_response(entry.response, entry.status_code)
+    for k, v in (entry.headers or {}).items():
+        response.headers[k] = v
+    return response
@@ -1,9 +1,13 @@
-from flask import url_for, jsonify
+from flask import url_for, jsonify, request, abort
 from flask.views import MethodView
+from flask_login import current_user
 from invenio_db import db
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_records_rest.views import need_record_permission, pass_record
 
-from oarepo_records_draft.exceptions import InvalidRecordException
+from oarepo_records_draft.exceptions import InvalidRecordException, RecordLockedException
+from oarepo_records_draft.models import DraftPublishJob, PUBLISH_JOB_COMPLETED
+from oarepo_records_draft.actions.idempotency import idempotent
 from oarepo_records_draft.proxies import current_drafts
 from oarepo_records_draft.types import RecordEndpointConfiguration, RecordContext
 
@@ -17,12 +21,15 @@ class PublishRecordAction(MethodView):
         super().__init__(**kwargs)
         self.endpoint = endpoint
 
+    @idempotent
     @pass_record
     @need_record_permission('publish_permission_factory')
     def post(self, pid, record, **kwargs):
         return self.publish(pid, record, **kwargs)
 
     def publish(self, pid, record, **kwargs):
+        if request.args.get('async', '').lower() in ('true', '1'):
+            return self.publish_async(pid, record, **kwargs)
         try:
             with db.session.begin_nested():
                 current_drafts.publish(RecordContext(record=record, record_pid=pid))
@@ -47,6 +54,177 @@ class PublishRecordAction(MethodView):
             response.status_code = 400
             return response
 
+    def publish_async(self, pid, record, **kwargs):
+        """
+        Collects and checks the records and creates a publish job which is executed
+        by ``invenio oarepo:drafts publish-worker``. Returns 202 with url of the job status.
+        """
+        try:
+            job = current_drafts.publish_chunked(
+                RecordContext(record=record, record_pid=pid), run=False,
+                user_id=current_user.get_id() if current_user.is_authenticated else None)
+        except InvalidRecordException as e:
+            response = jsonify({
+                "status": "error",
+                "message": e.message,
+                "errors": e.errors
+            })
+            response.status_code = 400
+            return response
+        url = url_for('oarepo_records_draft.' + PublishJobStatusAction.view_name, job_id=str(job.id), _external=True)
+        response = jsonify({
+            "status": "accepted",
+            "links": {
+                "status": url
+            }
+        })
+        response.status_code = 202
+        response.headers['location'] = url
+        return response
+
+    @property
+    def publish_permission_factory(self):
+        return self.endpoint.resolve('publish_permission_factory')
+
+
+class PublishJobStatusAction(MethodView):
+    """
+    Returns status and progress of an asynchronous (chunked) publish job. When the job
+    is completed, link to the published root record is returned. Only the user who started
+    the job can see it.
+    """
+    view_name = 'publish_job_status'
+
+    def get(self, job_id, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401)
+        job = DraftPublishJob.query.get(job_id)
+        if not job or job.user_id is None or job.user_id != str(current_user.get_id()):
+            abort(404)
+        links = {
+            "status": url_for('oarepo_records_draft.' + self.view_name, job_id=str(job.id), _external=True)
+        }
+        resp = {
+            "id": str(job.id),
+            "status": job.status,
+            "published": job.cursor,
+            "total": job.total,
+            "progress": job.progress,
+            "links": links
+        }
+        if job.error:
+            resp['message'] = job.error
+        if job.status == PUBLISH_JOB_COMPLETED:
+            links['published'] = self.published_url(job.pid_type, job.pid_value)
+        return jsonify(resp)
+
+    @staticmethod
+    def published_url(pid_type, pid_value):
+        endpoint = current_drafts.endpoint_for_pid_type(pid_type).paired_endpoint
+        return url_for('invenio_records_rest.{0}_item'.format(endpoint.rest_name),
+                       pid_value=pid_value, _external=True)
+
+
+class PublishRecordsAction(MethodView):
+    """
+    Publishes many draft records at once. The payload is a json list of pid values
+    (or ``{"pids": [...]}``). Each record is reported separately in the response,
+    an invalid record does not prevent the other records from being published.
+    """
+    view_name = 'publish_many_{0}'
+
+    def __init__(self,
+                 endpoint: RecordEndpointConfiguration,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint
+
+    @idempotent
+    def post(self, **kwargs):
+        payload = request.get_json(silent=True)
+        if isinstance(payload, dict):
+            payload = payload.get('pids')
+        if not isinstance(payload, list) or not payload:
+            abort(400, 'Expecting a list of pid values to publish')
+        pid_values = [str(x) for x in payload]
+
+        pids = {
+            pid.pid_value: pid for pid in PersistentIdentifier.query.filter(
+                PersistentIdentifier.pid_type == self.endpoint.pid_type,
+                PersistentIdentifier.pid_value.in_(pid_values),
+                PersistentIdentifier.status == PIDStatus.REGISTERED
+            )
+        }
+        records = {
+            record.id: record for record in self.endpoint.record_class.get_records(
+                [pid.object_uuid for pid in pids.values()])
+        }
+
+        item_results = {}
+        contexts = []
+        for pid_value in pid_values:
+            if pid_value in item_results:
+                continue
+            pid = pids.get(pid_value)
+            record = records.get(pid.object_uuid) if pid else None
+            if record is None:
+                item_results[pid_value] = {
+                    "pid": pid_value,
+                    "status": "error",
+                    "message": "Record not found"
+                }
+                continue
+            if not self.publish_permission_factory(record=record).can():
+                item_results[pid_value] = {
+                    "pid": pid_value,
+                    "status": "error",
+                    "message": "Permission denied"
+                }
+                continue
+            item_results[pid_value] = None
+            contexts.append(RecordContext(record=record, record_pid=pid))
+
+        if contexts:
+            for res in current_drafts.publish_many(contexts):
+                pid_value = res.record_context.record_pid.pid_value
+                item_results[pid_value] = self.publish_result(pid_value, res)
+            db.session.commit()
+
+        results = list(item_results.values())
+        return jsonify({
+            "status": "ok" if all(x['status'] == 'ok' for x in results) else "error",
+            "results": results
+        })
+
+    def publish_result(self, pid_value, res):
+        if res.ok:
+            endpoint = 'invenio_records_rest.{0}_item'.format(self.endpoint.paired_endpoint.rest_name)
+            return {
+                "pid": pid_value,
+                "status": "ok",
+                "links": {
+                    "published": url_for(endpoint, pid_value=pid_value, _external=True)
+                }
+            }
+        if isinstance(res.error, InvalidRecordException):
+            return {
+                "pid": pid_value,
+                "status": "error",
+                "message": res.error.message,
+                "errors": res.error.errors
+            }
+        if isinstance(res.error, RecordLockedException):
+            return {
+                "pid": pid_value,
+                "status": "error",
+                "message": res.error.description
+            }
+        return {
+            "pid": pid_value,
+            "status": "error",
+            "message": str(res.error)
+        }
+
     @property
     def publish_permission_factory(self):
         return self.endpoint.resolve('publish_permission_factory')
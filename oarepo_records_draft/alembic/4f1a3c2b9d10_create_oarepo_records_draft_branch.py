@@ -0,0 +1,15 @@
+"""Create oarepo_records_draft branch."""
+
+# revision identifiers, used by Alembic.
+revision = '4f1a3c2b9d10'
+down_revision = None
+branch_labels = ('oarepo_records_draft',)
+depends_on = 'dbdbc1b19cf2'
+
+
+def upgrade():
+    """Upgrade database."""
+
+
+def downgrade():
+    """Downgrade database."""
@@ -0,0 +1,91 @@
+"""Create indexing outbox, publish job, idempotency key and reindex checkpoint tables."""
+
+import sqlalchemy as sa
+import sqlalchemy_utils
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a3e6d1c0f5b2'
+down_revision = '4f1a3c2b9d10'
+branch_labels = ()
+# records_metadata table
+depends_on = '862037093962'
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_table(
+        'oarepo_draft_indexing_outbox',
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+                  autoincrement=True, nullable=False),
+        sa.Column('op_type', sa.String(length=10), nullable=False),
+        sa.Column('record_uuid', sqlalchemy_utils.types.uuid.UUIDType(), nullable=False),
+        sa.Column('pid_type', sa.String(length=6), nullable=True),
+        sa.Column('index', sa.String(length=255), nullable=False),
+        sa.Column('doc_type', sa.String(length=255), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_oarepo_draft_indexing_outbox'))
+    )
+    op.create_table(
+        'oarepo_draft_publish_job',
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        sa.Column('id', sqlalchemy_utils.types.uuid.UUIDType(), nullable=False),
+        sa.Column('status', sa.String(length=10), nullable=False),
+        sa.Column('pid_type', sa.String(length=6), nullable=False),
+        sa.Column('pid_value', sa.String(length=255), nullable=False),
+        sa.Column('records', sa.JSON(), nullable=False),
+        sa.Column('cursor', sa.Integer(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('chunk_size', sa.Integer(), nullable=False),
+        sa.Column('require_valid', sa.Boolean(name='require_valid'), nullable=False),
+        sa.Column('user_id', sa.String(length=255), nullable=True),
+        sa.Column('heartbeat', sa.DateTime(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_oarepo_draft_publish_job'))
+    )
+    op.create_table(
+        'oarepo_draft_idempotency_key',
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('path', sa.String(length=255), nullable=False),
+        sa.Column('user_id', sa.String(length=255), nullable=False),
+        sa.Column('request_hash', sa.String(length=64), nullable=True),
+        sa.Column('status_code', sa.Integer(), nullable=True),
+        sa.Column('response', sa.Text(), nullable=True),
+        sa.Column('headers', sa.JSON(), nullable=True),
+        sa.PrimaryKeyConstraint('key', 'path', 'user_id', name=op.f('pk_oarepo_draft_idempotency_key'))
+    )
+    op.create_table(
+        'oarepo_draft_reindex_checkpoint',
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        sa.Column('job_id', sa.String(length=255), nullable=False),
+        sa.Column('pid_type', sa.String(length=6), nullable=False),
+        sa.Column('last_uuid', sqlalchemy_utils.types.uuid.UUIDType(), nullable=True),
+        sa.Column('processed', sa.Integer(), nullable=False),
+        sa.Column('errors', sa.Integer(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=True),
+        sa.Column('finished', sa.Boolean(name='finished'), nullable=False),
+        sa.Column('started', sa.DateTime(), nullable=True),
+        sa.Column('since', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('job_id', 'pid_type', name=op.f('pk_oarepo_draft_reindex_checkpoint'))
+    )
+    op.create_index(
+        'ix_oarepo_draft_records_metadata_updated',
+        'records_metadata', ['updated'], unique=False
+    )
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index('ix_oarepo_draft_records_metadata_updated', table_name='records_metadata')
+    op.drop_table('oarepo_draft_reindex_checkpoint')
+    op.drop_table('oarepo_draft_idempotency_key')
+    op.drop_table('oarepo_draft_publish_job')
+    op.drop_table('oarepo_draft_indexing_outbox')
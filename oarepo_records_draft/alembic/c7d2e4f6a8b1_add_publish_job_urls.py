@@ -0,0 +1,20 @@
+"""Add urls of the records to publish job."""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e4f6a8b1'
+down_revision = 'a3e6d1c0f5b2'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.add_column('oarepo_draft_publish_job', sa.Column('urls', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_column('oarepo_draft_publish_job', 'urls')
@@ -0,0 +1,67 @@
+from flask import g, has_app_context
+from invenio_pidstore.models import PIDStatus
+
+from oarepo_records_draft.indexing import IndexingOperations
+from oarepo_records_draft.proxies import current_drafts
+
+
+class DraftBatch:
+    """
+    Work deferred by draft actions (publish, edit, unpublish) called inside
+    ``with current_drafts.batch():`` - elasticsearch operations, refreshes and pid deletions.
+    They are applied at once when the block exits.
+    """
+
+    def __init__(self, refresh_policy=None):
+        self.refresh_policy = refresh_policy
+        self.operations = IndexingOperations(refresh_policy=refresh_policy)
+        # (object_type, object_uuid) => pid of deleted records
+        self.deleted_pids = {}
+        # (object_type, object_uuid) => ids of pids of the object that have already been marked as deleted
+        self.applied_pids = {}
+
+    def delete_pids(self, pids):
+        for pid in pids:
+            key = (pid.object_type, pid.object_uuid)
+            self.deleted_pids[key] = pid
+            self.applied_pids.pop(key, None)
+
+    def apply_deleted_pid(self, pid):
+        """
+        Called when a pid is resolved within the batch. If the object of the pid has been deleted
+        earlier in the batch, the deletion is applied to the pid right now so that the caller sees
+        the correct status. Other pids of the object are deleted when the batch is flushed.
+        """
+        key = (pid.object_type, pid.object_uuid)
+        if key not in self.deleted_pids:
+            return
+        applied = self.applied_pids.setdefault(key, set())
+        if pid.id in applied:
+            # already handled, the caller might have registered the pid again
+            return
+        applied.add(pid.id)
+        if pid.status != PIDStatus.DELETED:
+            pid.status = PIDStatus.DELETED
+
+    def flush(self):
+        """
+        Deletes pids of deleted records and sends the elasticsearch operations in one bulk request.
+
+        :return: a list of ``IndexingResult``
+        """
+        current_drafts.delete_object_pids(
+            list(self.deleted_pids.values()),
+            exclude=[pid_id for pid_ids in self.applied_pids.values() for pid_id in pid_ids])
+        self.deleted_pids = {}
+        self.applied_pids = {}
+        operations, self.operations = self.operations, IndexingOperations(refresh_policy=self.refresh_policy)
+        return operations.execute()
+
+
+def get_draft_batch():
+    """
+    Returns the active ``DraftBatch`` or None if not called inside ``with current_drafts.batch():``
+    """
+    if not has_app_context():
+        return None
+    return g.get('oarepo_draft_batch')
@@ -1,7 +1,9 @@
 import datetime
 import itertools
 import json
+import time
 import traceback
+from collections import deque
 from multiprocessing import Pool
 
 import click
@@ -12,16 +14,15 @@ from invenio_app.factory import create_api
 from invenio_db import db
 from invenio_indexer.utils import _es7_expand_action
 from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.models import RecordMetadata
+from sqlalchemy import func
 
 from oarepo_records_draft import current_drafts
+from oarepo_records_draft.actions.idempotency import purge_idempotency_keys
+from oarepo_records_draft.indexing import drain_outbox, index_action, requeue_outbox
+from oarepo_records_draft.models import DraftPublishJob, PUBLISH_JOB_COMPLETED, DraftReindexCheckpoint
 from oarepo_records_draft.types import RecordEndpointConfiguration
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    def tqdm(iterable, disable=False):
-        return iterable
-
 
 def grouper(n, iterable):
     iterable = iter(iterable)
@@ -33,57 +34,300 @@ def drafts():
     """OARepo record drafts commands."""
 
 
+def parse_since(ctx, param, value):
+    if not value:
+        return None
+    try:
+        since = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise click.BadParameter(f'Not an ISO datetime: {value}')
+    if since.tzinfo is not None:
+        # timestamps in the database are naive UTC
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return since
+
+
 @drafts.command('reindex')
 @click.option('--pid-type', '-t', help='Limit revalidate to a given pid type')
 @click.option('--pid', '-p', help='Limit revalidate to a given pid of form pid_type:pid_value')
 @click.option('--processes', default=5, help='Number of database processes')
 @click.option('--bulk-size', default=500, help='Number of records to index at the same time')
+@click.option('--max-in-flight', default=0,
+              help='Maximum number of batches queued for the processes, defaults to 2 * processes')
+@click.option('--job-id', help='Record progress of the reindex under this id so that it can be resumed')
+@click.option('--resume/--restart', default=False,
+              help='With --job-id, continue after the last completed batch of the job')
+@click.option('--since', callback=parse_since,
+              help='Reindex only records changed after this ISO datetime (and remove deleted ones)')
+@click.option('--since-last-run', is_flag=True,
+              help='Reindex only records changed after the start of the last finished reindex with --job-id')
 @click.option('--save/--no-save', '-s', default=False, help='If the validation is successful, commit the record')
 @click.option('--verbose/--quiet', '-v', default=False, help='Print details')
 @with_appcontext
-def reindex_records(pid_type, pid, save, verbose, processes, bulk_size):
+def reindex_records(pid_type, pid, save, verbose, processes, bulk_size, max_in_flight, job_id, resume,
+                    since, since_last_run):
+    if since and since_last_run:
+        raise click.UsageError('--since and --since-last-run can not be used together')
     if pid:
         return index_single_pid(pid, verbose)
 
     start = datetime.datetime.now()
-    if pid_type:
-        pid_types = {pid_type}
-    else:
-        pid_types = set([
-            *[x.draft.pid_type for x in current_drafts.managed_records],
-            *[x.published.pid_type for x in current_drafts.managed_records]
-        ])
+    pid_types = get_reindex_pid_types(pid_type)
+    max_in_flight = max_in_flight or 2 * processes
+    checkpoints, since_by_pid_type = prepare_reindex(job_id, pid_types, resume, since, since_last_run)
+    totals = {'ok': 0, 'errors': 0, 'processed': 0}
 
     with Pool(processes=processes) as pool:
         req_timeout = current_app.config['INDEXER_BULK_REQUEST_TIMEOUT']
-        results = []
-        if verbose:
-            print('Generating indexing tasks')
-        for pid_type in tqdm(pid_types, disable=not verbose):
-            object_uuids = [x[0] for x in db.session.query(PersistentIdentifier.object_uuid).filter(
-                PersistentIdentifier.pid_type == pid_type,
-                PersistentIdentifier.status == PIDStatus.REGISTERED.value)]
-            if not len(object_uuids):
-                continue
-            for object_uuids_group in grouper(bulk_size, object_uuids):
-                results.append(
+        in_flight = deque()
+        for pid_type in pid_types:
+            for object_uuids_group in reindex_batches(pid_type, checkpoints.get(pid_type),
+                                                      since_by_pid_type.get(pid_type), bulk_size,
+                                                      req_timeout, totals, verbose):
+                # backpressure - do not queue more than max_in_flight batches
+                while len(in_flight) >= max_in_flight:
+                    gather(in_flight.popleft(), checkpoints, totals, start, verbose)
+                in_flight.append((
                     pool.apply_async(bulk_indexer,
-                                     args=(pid_type, object_uuids_group, req_timeout)))
-        ok = 0
-        errors = 0
-        if verbose:
-            print('Gathering indexing results')
-        for res in tqdm(results, disable=not verbose):
-            res_ok, res_errors = res.get()
-            ok += res_ok
-            if res_errors:
-                errors += len(res_errors)
-                if verbose:
-                    for err in res_errors:
-                        print(json.dumps(err, default=lambda x: str(x)))
+                                     args=(pid_type, object_uuids_group, req_timeout)),
+                    pid_type, len(object_uuids_group), object_uuids_group[-1]
+                ))
+        while in_flight:
+            gather(in_flight.popleft(), checkpoints, totals, start, verbose)
+        for checkpoint in checkpoints.values():
+            checkpoint.finished = True
+        db.session.commit()
         end = datetime.datetime.now()
         if verbose:
-            print(f'Total {ok} ok, {errors} errors in {end - start}')
+            print(f'Total {totals["ok"]} ok, {totals["errors"]} errors in {end - start}')
+
+
+def get_reindex_pid_types(pid_type=None):
+    """
+    Returns sorted pid types to reindex - the given one or pid types of all managed records.
+    """
+    if pid_type:
+        return [pid_type]
+    return sorted({
+        *[x.draft.pid_type for x in current_drafts.managed_records],
+        *[x.published.pid_type for x in current_drafts.managed_records]
+    })
+
+
+def prepare_reindex(job_id, pid_types, resume, since, since_last_run):
+    """
+    Computes the time window of each pid type and creates (or loads) the checkpoints of the job.
+
+    :return: a tuple (pid_type => DraftReindexCheckpoint, pid_type => reindex records changed after this time)
+    """
+    if since_last_run:
+        since_by_pid_type = get_last_reindex_runs(pid_types)
+        for missing_pid_type in set(pid_types) - set(since_by_pid_type):
+            print(f'No finished reindex of {missing_pid_type}, reindexing all records')
+    else:
+        since_by_pid_type = {x: since for x in pid_types if since}
+
+    if not job_id:
+        return {}, since_by_pid_type
+
+    checkpoints = get_reindex_checkpoints(job_id, pid_types, resume, since_by_pid_type)
+    for checkpoint in checkpoints.values():
+        # when resuming, keep the time window of the interrupted run
+        if checkpoint.since:
+            since_by_pid_type[checkpoint.pid_type] = checkpoint.since
+        else:
+            since_by_pid_type.pop(checkpoint.pid_type, None)
+    return checkpoints, since_by_pid_type
+
+
+def gather(entry, checkpoints, totals, start, verbose):
+    """
+    Waits for a queued batch, adds its results to ``totals`` and moves the checkpoint of its pid type.
+
+    :param entry: tuple (async result, pid type, number of records in the batch, last uuid of the batch)
+    """
+    res, res_pid_type, batch_size, last_uuid = entry
+    res_ok, res_errors = res.get()
+    totals['ok'] += res_ok
+    totals['processed'] += batch_size
+    if res_errors:
+        totals['errors'] += len(res_errors)
+        if verbose:
+            for err in res_errors:
+                print(json.dumps(err, default=lambda x: str(x)))
+    checkpoint = checkpoints.get(res_pid_type)
+    if checkpoint:
+        # batches are gathered in the order they were queued, so all records
+        # up to last_uuid have been processed
+        checkpoint.last_uuid = last_uuid
+        checkpoint.processed += batch_size
+        checkpoint.errors += len(res_errors or [])
+        db.session.commit()
+    if verbose:
+        print_reindex_progress(res_pid_type, checkpoint, totals, start)
+
+
+def reindex_batches(pid_type, checkpoint, since, bulk_size, req_timeout, totals, verbose):
+    """
+    Yields batches of object uuids of the pid type to be reindexed, continuing after the checkpoint.
+    If ``since`` is set, records deleted after it are removed from the index first.
+    """
+    if checkpoint and checkpoint.finished:
+        return
+    if verbose:
+        print(f'Indexing pid type {pid_type}')
+    after_uuid = checkpoint.last_uuid if checkpoint else None
+    if since and not after_uuid:
+        # deletes go first so that a record deleted and registered again in the window is reindexed
+        remove_deleted_records(pid_type, since, req_timeout, totals, verbose)
+    yield from grouper(bulk_size, stream_object_uuids(pid_type, bulk_size, after_uuid, since=since))
+
+
+def remove_deleted_records(pid_type, since, req_timeout, totals, verbose):
+    deleted_ok, deleted_errors = delete_deleted_records(pid_type, since, req_timeout)
+    totals['ok'] += deleted_ok
+    totals['errors'] += len(deleted_errors)
+    if verbose:
+        print(f'Removed {deleted_ok} records deleted since {since} from index')
+        for err in deleted_errors:
+            print(json.dumps(err, default=lambda x: str(x)))
+
+
+def object_uuids_query(pid_type, since=None):
+    """
+    Query for object uuids of registered pids of the given type. If ``since`` is set,
+    only records updated after it are returned (uses the index on ``records_metadata.updated``).
+    """
+    query = db.session.query(PersistentIdentifier.object_uuid)
+    if since:
+        query = query.join(RecordMetadata, RecordMetadata.id == PersistentIdentifier.object_uuid).filter(
+            RecordMetadata.updated >= since
+        )
+    return query.filter(
+        PersistentIdentifier.pid_type == pid_type,
+        PersistentIdentifier.status == PIDStatus.REGISTERED.value
+    )
+
+
+def stream_object_uuids(pid_type, batch_size, after_uuid=None, since=None):
+    """
+    Streams object uuids of registered pids of the given type, ordered by uuid. The uuids are fetched
+    in pages of ``batch_size`` (keyset pagination on the uuid), so no long-running transaction
+    nor cursor is held while the records are being indexed.
+
+    :param after_uuid: stream only uuids greater than this one
+    :param since: stream only records updated after this time
+    """
+    while True:
+        query = object_uuids_query(pid_type, since)
+        if after_uuid:
+            query = query.filter(PersistentIdentifier.object_uuid > after_uuid)
+        page = [x[0] for x in query.order_by(PersistentIdentifier.object_uuid).limit(batch_size)]
+        db.session.commit()
+        yield from page
+        if len(page) < batch_size:
+            break
+        after_uuid = page[-1]
+
+
+def delete_deleted_records(pid_type, since, req_timeout):
+    """
+    Removes records whose pids of the given type were deleted after ``since`` from all indices
+    of the pid type's endpoint. Documents that are not in an index are not reported as errors.
+    """
+    endpoint: RecordEndpointConfiguration = current_drafts.endpoint_for_pid_type(pid_type)
+    indexer = endpoint.indexer_class()
+    indices = {
+        indexer._prepare_index(index, '_doc') for index in endpoint.schema_indices.values() if index
+    }
+    object_uuids = db.session.query(PersistentIdentifier.object_uuid).filter(
+        PersistentIdentifier.pid_type == pid_type,
+        PersistentIdentifier.status == PIDStatus.DELETED.value,
+        PersistentIdentifier.updated >= since,
+        PersistentIdentifier.object_uuid.isnot(None)
+    )
+    actions = (
+        {
+            '_op_type': 'delete',
+            '_index': index,
+            '_type': doc_type,
+            '_id': str(object_uuid)
+        }
+        for (object_uuid,) in object_uuids
+        for index, doc_type in indices
+    )
+    success, errors = bulk(
+        indexer.client,
+        actions,
+        stats_only=False,
+        request_timeout=req_timeout,
+        expand_action_callback=_es7_expand_action,
+        raise_on_error=False,
+        raise_on_exception=False
+    )
+    errors = [
+        err for err in errors if err.get('delete', {}).get('status') != 404
+    ]
+    return success, errors
+
+
+def get_last_reindex_runs(pid_types):
+    """
+    Returns a dictionary pid_type => start of the last finished reindex of the pid type.
+    """
+    return dict(
+        db.session.query(DraftReindexCheckpoint.pid_type, func.max(DraftReindexCheckpoint.started)).filter(
+            DraftReindexCheckpoint.pid_type.in_(pid_types),
+            DraftReindexCheckpoint.finished.is_(True),
+            DraftReindexCheckpoint.started.isnot(None)
+        ).group_by(DraftReindexCheckpoint.pid_type)
+    )
+
+
+def get_reindex_checkpoints(job_id, pid_types, resume, since_by_pid_type):
+    """
+    Returns a dictionary pid_type => DraftReindexCheckpoint for the job, creating the checkpoints
+    if they do not exist (or if not resuming).
+    """
+    started = datetime.datetime.utcnow()
+    if not resume:
+        DraftReindexCheckpoint.query.filter_by(job_id=job_id).delete()
+    checkpoints = {
+        cp.pid_type: cp for cp in DraftReindexCheckpoint.query.filter_by(job_id=job_id)
+    }
+    for pid_type in pid_types:
+        if pid_type not in checkpoints:
+            checkpoints[pid_type] = DraftReindexCheckpoint(
+                job_id=job_id, pid_type=pid_type, processed=0, errors=0, finished=False,
+                started=started, since=since_by_pid_type.get(pid_type),
+                total=object_uuids_query(pid_type, since_by_pid_type.get(pid_type)).count()
+            )
+            db.session.add(checkpoints[pid_type])
+    db.session.commit()
+    return checkpoints
+
+
+def print_reindex_progress(pid_type, checkpoint, totals, start):
+    elapsed = datetime.datetime.now() - start
+    if checkpoint is None or not checkpoint.total:
+        print(f'{pid_type}: {totals["processed"]} processed in {elapsed}')
+        return
+    remaining = max(checkpoint.total - checkpoint.processed, 0)
+    eta = elapsed * remaining / totals['processed'] if totals['processed'] else None
+    print(f'{pid_type}: {checkpoint.processed}/{checkpoint.total} '
+          f'({100 * checkpoint.processed / checkpoint.total:.1f}%), '
+          f'{checkpoint.errors} errors, elapsed {elapsed}, remaining {eta or "unknown"}')
+
+
+@drafts.command('reindex-jobs')
+@with_appcontext
+def reindex_jobs_command():
+    """Print progress of reindex jobs started with --job-id."""
+    for checkpoint in DraftReindexCheckpoint.query.order_by(DraftReindexCheckpoint.job_id,
+                                                            DraftReindexCheckpoint.pid_type):
+        status = 'finished' if checkpoint.finished else f'last uuid {checkpoint.last_uuid}'
+        print(f'{checkpoint.job_id} {checkpoint.pid_type} {checkpoint.processed}/{checkpoint.total} '
+              f'{checkpoint.errors} errors, {status}, updated {checkpoint.updated}')
 
 
 bulk_app = []
@@ -101,21 +345,21 @@ def bulk_indexer(pid_type, object_uuids, req_timeout):
             indexer_class = endpoint.indexer_class
 
             indexer = indexer_class()
-            # force record class
-            indexer.record_cls = record_class
 
-            def get_indexing_data(record_uuid):
+            def get_indexing_data(record):
                 try:
-                    return indexer._index_action({"id": record_uuid})
+                    return index_action(indexer, record)
                 except Exception as e:
                     exceptions.append({
-                        'record_uuid': str(record_uuid),
+                        'record_uuid': str(record.id),
                         'message': str(e),
                         'traceback': traceback.format_exc(),
                     })
-                return {}
+                return None
 
-            recs = (get_indexing_data(record_uuid) for record_uuid in object_uuids)
+            # load the whole batch in a single query
+            records = record_class.get_records(object_uuids)
+            recs = filter(None, (get_indexing_data(record) for record in records))
 
             success, errors = bulk(
                 indexer.client,
@@ -142,7 +386,7 @@ def bulk_indexer(pid_type, object_uuids, req_timeout):
             errors = []
             if len(object_uuids) > 4:
                 # split into two halves and try for each half
-                mid = len(object_uuids) / 2
+                mid = len(object_uuids) // 2
                 object_uuids = [
                     object_uuids[:mid],
                     object_uuids[mid:]
@@ -157,6 +401,174 @@ def bulk_indexer(pid_type, object_uuids, req_timeout):
             return ok, errors
 
 
+@drafts.command('drain-outbox')
+@click.option('--processes', default=1, help='Number of drainer processes')
+@click.option('--batch-size', default=500, help='Number of outbox entries applied in one bulk request')
+@click.option('--loop/--once', default=False, help='Keep polling the outbox instead of exiting when it is empty')
+@click.option('--interval', default=5.0,
+              help='Seconds to wait before polling an empty outbox again or when elasticsearch '
+                   'is not available (with --loop)')
+@click.option('--verbose/--quiet', '-v', default=False, help='Print details')
+@with_appcontext
+def drain_outbox_command(processes, batch_size, loop, interval, verbose):
+    """Apply pending elasticsearch operations from the indexing outbox."""
+    start = datetime.datetime.now()
+    ok = 0
+    errors = 0
+    with Pool(processes=processes) as pool:
+        while True:
+            results = [
+                pool.apply_async(outbox_drainer, args=(batch_size,)) for _ in range(processes)
+            ]
+            claimed = 0
+            for res in results:
+                res_claimed, res_ok, res_errors = res.get()
+                claimed += res_claimed
+                ok += res_ok
+                errors += len(res_errors)
+                if verbose:
+                    for err in res_errors:
+                        print(json.dumps(err, default=lambda x: str(x)))
+            if not claimed:
+                if not loop:
+                    break
+                time.sleep(interval)
+    end = datetime.datetime.now()
+    if verbose:
+        print(f'Total {ok} ok, {errors} errors in {end - start}')
+
+
+@drafts.command('requeue-outbox')
+@with_appcontext
+def requeue_outbox_command():
+    """Retry outbox operations that failed OAREPO_DRAFT_INDEXING_OUTBOX_MAX_ATTEMPTS times."""
+    print(f'Requeued {requeue_outbox()} operations')
+
+
+@drafts.command('purge-idempotency-keys')
+@click.option('--batch-size', default=1000, help='Number of keys removed in one transaction')
+@with_appcontext
+def purge_idempotency_keys_command(batch_size):
+    """Remove responses stored for Idempotency-Key older than OAREPO_DRAFT_IDEMPOTENCY_KEY_TTL."""
+    print(f'Removed {purge_idempotency_keys(batch_size)} idempotency keys')
+
+
+def outbox_drainer(batch_size):
+    """
+    Drains the outbox until there is nothing left to claim.
+
+    :return: tuple (claimed rows, successfully applied rows, errors)
+    """
+    if not bulk_app:
+        bulk_app.append(create_api())
+
+    claimed = 0
+    ok = 0
+    errors = []
+    with bulk_app[0].app_context():
+        while True:
+            batch_claimed, batch_ok, batch_errors = drain_outbox(batch_size)
+            errors.extend(batch_errors)
+            if not batch_claimed:
+                # empty outbox or elasticsearch not available
+                break
+            claimed += batch_claimed
+            ok += batch_ok
+            if not batch_ok:
+                # only failing operations left in this batch, leave them to the next run
+                break
+    return claimed, ok, errors
+
+
+@drafts.command('publish-jobs')
+@click.option('--all/--unfinished', 'show_all', default=False, help='Show also completed jobs')
+@with_appcontext
+def publish_jobs_command(show_all):
+    """List chunked publish jobs and their progress."""
+    query = DraftPublishJob.query
+    if not show_all:
+        query = query.filter(DraftPublishJob.status != PUBLISH_JOB_COMPLETED)
+    for job in query.order_by(DraftPublishJob.created):
+        print(f'{job.id} {job.pid_type}:{job.pid_value} {job.status} '
+              f'{job.cursor}/{job.total} {job.error or ""}'.strip())
+
+
+@drafts.command('resume-publish')
+@click.argument('job_id', required=False)
+@with_appcontext
+def resume_publish_command(job_id):
+    """
+    Resume a failed or abandoned chunked publish job (all such jobs if JOB_ID is not given).
+    Jobs being executed by a live worker are not touched.
+    """
+    if job_id:
+        if not DraftPublishJob.query.get(job_id):
+            raise click.BadParameter(f'Publish job {job_id} not found', param_hint='job_id')
+        job_ids = [job_id]
+    else:
+        job_ids = [x[0] for x in db.session.query(DraftPublishJob.id).filter(
+            DraftPublishJob.status != PUBLISH_JOB_COMPLETED).order_by(DraftPublishJob.created)]
+    for claimed_id in job_ids:
+        job = current_drafts.claim_publish_job(claimed_id, resume_failed=True)
+        if job is None:
+            print(f'{claimed_id} is completed or being executed by another worker')
+            continue
+        current_drafts.run_publish_job(job)
+        print(f'{job.id} {job.pid_type}:{job.pid_value} {job.status} '
+              f'{job.cursor}/{job.total} {job.error or ""}'.strip())
+
+
+@drafts.command('publish-worker')
+@click.option('--processes', default=1, help='Number of worker processes')
+@click.option('--loop/--once', default=True, help='Keep polling for new jobs instead of exiting when there are none')
+@click.option('--interval', default=5.0, help='Seconds to wait before polling for new jobs again (with --loop)')
+@click.option('--verbose/--quiet', '-v', default=False, help='Print details')
+@with_appcontext
+def publish_worker_command(processes, loop, interval, verbose):
+    """Execute pending asynchronous publish jobs and jobs abandoned by crashed workers."""
+    with Pool(processes=processes) as pool:
+        while True:
+            results = [
+                pool.apply_async(publish_worker) for _ in range(processes)
+            ]
+            executed = 0
+            for res in results:
+                for job_id, status, error in res.get():
+                    executed += 1
+                    if verbose:
+                        print(f'{job_id} {status} {error or ""}'.strip())
+            if not executed:
+                if not loop:
+                    break
+                time.sleep(interval)
+
+
+def publish_worker():
+    """
+    Executes pending publish jobs until there is nothing left to claim.
+
+    :return: list of (job id, status, error) of executed jobs
+    """
+    if not bulk_app:
+        bulk_app.append(create_api())
+
+    with bulk_app[0].app_context():
+        return [
+            (str(job.id), job.status, job.error) for job in current_drafts.run_pending_publish_jobs()
+        ]
+
+
+@drafts.command('routing')
+@with_appcontext
+def routing_command():
+    """Print the precomputed (record class, $schema) => index routing table."""
+    for (record_class, schema), route in sorted(
+            current_drafts.index_routing.items(),
+            key=lambda x: (x[0][0].__module__, x[0][0].__name__, x[0][1])):
+        print(f'{record_class.__module__}.{record_class.__name__} {schema} => '
+              f'{route.alias} (index {route.index}, doc type {route.doc_type})')
+
+
 def index_single_pid(pid, verbose):
     pid_type, pid_value = pid.split(':', maxsplit=1)
     pids = PersistentIdentifier.query.filter(
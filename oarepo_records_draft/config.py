@@ -0,0 +1,93 @@
+OAREPO_DRAFT_REFRESH_POLICY = {
+    'draft': 'refresh+flush',
+    'published': 'refresh+flush'
+}
+"""
+What is done with elasticsearch indices after publish/edit/unpublish. Either a single value
+used for both draft and published indices or a dictionary with ``draft`` and ``published`` keys.
+The policy can be overridden for a single call via the ``refresh_policy`` argument.
+
+   * ``none`` - nothing is done, documents are visible after the next periodic refresh
+   * ``wait_for`` - the indexing request waits until the documents are visible (``refresh=wait_for``)
+   * ``refresh`` - affected indices are refreshed
+   * ``refresh+flush`` - affected indices are refreshed and flushed
+"""
+
+OAREPO_DRAFT_INDEXING_OUTBOX = False
+"""
+If True, elasticsearch operations on draft-managed records are not performed inline but written
+to the ``oarepo_draft_indexing_outbox`` table in the same database transaction as the change
+of the record. Run ``invenio oarepo:drafts drain-outbox`` to apply them.
+"""
+
+OAREPO_DRAFT_INDEXING_OUTBOX_MAX_ATTEMPTS = 5
+"""
+Outbox operations that failed this many times are not retried by ``drain-outbox``. Use
+``invenio oarepo:drafts requeue-outbox`` to retry them again.
+"""
+
+OAREPO_DRAFT_INDEXING_OUTBOX_RETRY_DELAY = 10
+"""
+Number of seconds before a failed outbox operation is retried. The delay doubles with each failed attempt.
+"""
+
+OAREPO_DRAFT_INDEXING_QUEUE = True
+"""
+If True, elasticsearch operations performed within a request are queued and sent in a single
+bulk request at the end of the request, after the database transaction has been committed.
+Repeated operations on the same document within the request are coalesced to the last one.
+"""
+
+OAREPO_DRAFT_FILE_COPY_BATCH_SIZE = 500
+"""
+Number of files copied between draft and published bucket in one batch (one bulk insert
+of object versions and one of their tags).
+"""
+
+OAREPO_DRAFT_INDEXING_CHUNK_SIZE = 500
+"""
+Number of elasticsearch operations sent in one chunk of a bulk request.
+"""
+
+OAREPO_DRAFT_INDEXING_THREADS = 1
+"""
+If greater than 1 and a draft action (for example publishing of a wide graph of records) produces
+more than ``OAREPO_DRAFT_INDEXING_CHUNK_SIZE`` elasticsearch operations, the chunks are sent
+concurrently from this number of threads.
+"""
+
+OAREPO_DRAFT_PUBLISH_CHUNK_SIZE = 100
+"""
+Number of records published in one database transaction by ``publish_chunked``.
+"""
+
+OAREPO_DRAFT_PUBLISH_JOB_LEASE = 600
+"""
+Number of seconds after which a running publish job that has not reported progress (a chunk has not
+been committed) is considered abandoned (its worker crashed) and can be claimed by another worker.
+Must be longer than the time needed to publish one chunk.
+"""
+
+OAREPO_DRAFT_IDEMPOTENCY_KEY_TTL = 24 * 3600
+"""
+Number of seconds the response of a draft action performed with ``Idempotency-Key`` header is kept.
+A request with the same key after this period is performed again.
+"""
+
+OAREPO_DRAFT_IDEMPOTENCY_KEY_LEASE = 300
+"""
+Number of seconds after which a request with ``Idempotency-Key`` that has not finished is considered
+abandoned (for example, its worker process has been killed) and a repeated request performs the action again.
+Must be longer than the longest draft action.
+"""
+
+OAREPO_DRAFT_RECORD_LOCKING = 'nowait'
+"""
+Locking of collected records in publish, edit and unpublish. The database rows of the records are
+locked (``SELECT ... FOR UPDATE``) in a deterministic order, so concurrent actions on overlapping
+sets of records can not deadlock.
+
+* ``nowait`` - if some of the records are locked, ``RecordLockedException`` (409) is raised immediately
+* ``wait`` - wait until the records are unlocked
+* ``None`` - do not lock the records
+"""
@@ -1,3 +1,6 @@
+from invenio_rest.errors import RESTException
+
+
 class InvalidRecordException(Exception):
     def __init__(self, message, errors):
         super().__init__(message)
@@ -18,3 +21,12 @@ class FatalDraftException(Exception):
     for security reasons.
     """
     pass
+
+
+class RecordLockedException(RESTException):
+    """
+    Raised when some of the records processed by a draft action are locked by another action
+    (or have been modified by it). The action can be retried later.
+    """
+    code = 409
+    description = 'Some of the records are being processed by another request, please try again later'
@@ -1,41 +1,78 @@
+import contextlib
 import copy
+import datetime
 import functools
 import logging
-import traceback
 import uuid
-from collections import namedtuple
-from typing import List, Union
+from collections import namedtuple, deque
+from types import MappingProxyType
+from typing import List, Optional, Union
 
 import invenio_indexer.config
 import pkg_resources
+from flask import url_for, g
 from invenio_base.signals import app_loaded
 from invenio_base.utils import obj_or_import_string
 from invenio_db import db
+from invenio_files_rest.errors import BucketLockedError
 from invenio_files_rest.models import ObjectVersion, ObjectVersionTag
 from invenio_indexer.api import RecordIndexer
 from invenio_indexer.utils import schema_to_index
 from invenio_pidstore.errors import PIDDoesNotExistError
 from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_records import Record
-from invenio_search import current_search, current_search_client
+from invenio_search import current_search
 from oarepo_validate.record import AllowedSchemaMixin
+from sqlalchemy import or_, and_, event, cast, Text
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy_continuum import version_class
+from werkzeug.routing import BuildError
 
+from oarepo_records_draft import config
 from oarepo_records_draft.mappings import setup_draft_mappings
 from oarepo_records_draft.types import DraftManagedRecords
-from .exceptions import InvalidRecordException
-from .signals import collect_records, CollectAction, check_can_publish, before_publish, after_publish, check_can_edit, \
-    before_edit, after_edit, check_can_unpublish, before_unpublish, after_unpublish, before_publish_record, \
-    before_unpublish_record, after_publish_record, file_copied
+from .batch import DraftBatch, get_draft_batch
+from .exceptions import InvalidRecordException, RecordLockedException
+from .models import DraftPublishJob, PUBLISH_JOB_PENDING, PUBLISH_JOB_RUNNING, PUBLISH_JOB_COMPLETED, \
+    PUBLISH_JOB_FAILED
+from .indexing import IndexingOperations, record_index, session_after_commit, session_after_transaction_end, \
+    flush_indexing_queue
+from .signals import collect_records, collect_records_batch, CollectAction, check_can_publish, before_publish, \
+    after_publish, check_can_edit, before_edit, after_edit, check_can_unpublish, before_unpublish, after_unpublish, \
+    before_publish_record, before_unpublish_record, after_publish_record, file_copied
 from .types import RecordContext, Endpoints
+from .utils import clone_metadata, same_content, UrlRewriter
 from .views import register_blueprint
 
 logger = logging.getLogger(__name__)
 
+IndexRoute = namedtuple('IndexRoute', 'index doc_type alias')
+IndexRoute.__doc__ = """
+Where a record is indexed.
+
+:param index: index name as returned from ``record_to_index``
+:param doc_type: document type
+:param alias: index name with the search prefix, as used in elasticsearch requests
+"""
+
 PublishedDraftRecordPair = namedtuple(
     'PublishedDraftRecordPair',
     'published_context draft_context primary')
 
+PublishManyResult = namedtuple(
+    'PublishManyResult',
+    'record_context ok pairs error')
+"""
+Result of publishing a single record via ``publish_many``.
+
+:param record_context: RecordContext of the draft record passed to ``publish_many``
+:param ok: True if the record (and all its collected records) has been published
+:param pairs: a list of PublishedDraftRecordPair for records published on behalf of this record.
+              Records that have already been published on behalf of a previous record are not included.
+:param error: the exception if the record could not be published
+"""
+
 
 def setup_indexer(app):
     if app.config['INDEXER_RECORD_TO_INDEX'] == invenio_indexer.config.INDEXER_RECORD_TO_INDEX:
@@ -49,6 +86,8 @@ class RecordsDraftState:
     def __init__(self, app):
         self.app = app
         self.managed_records = None  # type: DraftManagedRecords
+        # (record class, $schema) => IndexRoute, built in app_loaded
+        self.index_routing = MappingProxyType({})
         self._uploaders = None
         self._extra_actions = None
 
@@ -57,6 +96,7 @@ class RecordsDraftState:
             app.config['RECORDS_REST_ENDPOINTS'].setup_endpoints()
             self._collect_mappings()
             setup_indexer(app)
+            self._build_index_routing(app)
             setup_draft_mappings(self.managed_records, app)
             register_blueprint(app, self)
 
@@ -72,30 +112,91 @@ class RecordsDraftState:
                 rec.published.set_index(json_schema, index_name)
                 rec.draft.set_index(json_schema, index_name)
 
+    def _build_index_routing(self, app):
+        """
+        Precomputes index (and index alias) for each managed record class and its allowed schemas
+        so that ``record_to_index`` is a single dictionary lookup. Used only when the library's
+        ``record_to_index`` is configured.
+        """
+        routing = {}
+        if app.config['INDEXER_RECORD_TO_INDEX'] == 'oarepo_records_draft.record.record_to_index':
+            for rec in self.managed_records:
+                for endpoint in (rec.draft, rec.published):
+                    indexer = endpoint.indexer_class()
+                    for schema, index in endpoint.schema_indices.items():
+                        if not index:
+                            continue
+                        alias, doc_type = indexer._prepare_index(index, '_doc')
+                        routing[(endpoint.record_class, schema)] = IndexRoute(
+                            index=index, doc_type='_doc', alias=alias)
+        self.index_routing = MappingProxyType(routing)
+
+    def index_route(self, record):
+        """
+        Returns ``IndexRoute`` of the record from the routing table or None if the record class
+        and its schema are not in the table.
+        """
+        schema = record.get('$schema', '')
+        if isinstance(schema, dict):
+            schema = schema.get('$ref', '')
+        return self.index_routing.get((type(record), schema))
+
     @staticmethod
     def collect_records_for_action(record: RecordContext, action) -> List[RecordContext]:
         records_to_publish_map = set()
         records_to_publish = [record]
-        records_to_publish_queue = [record]
+        records_to_publish_queue = deque([record])
         records_to_publish_map.add(record.record_uuid)
 
+        def add_collected_records(collected_records):
+            # collect_record: RecordContext
+            for collect_record in (collected_records or []):
+                if collect_record.record_uuid in records_to_publish_map:
+                    continue
+                records_to_publish_map.add(collect_record.record_uuid)
+                records_to_publish.append(collect_record)
+                records_to_publish_queue.append(collect_record)
+
         while records_to_publish_queue:
-            rec = records_to_publish_queue.pop(0)
-            for _, collected_records in collect_records.send(
+            # process the whole frontier at once so that batch receivers can resolve it together
+            frontier = list(records_to_publish_queue)
+            records_to_publish_queue.clear()
+            # lazy record contexts of the frontier are loaded in one query per record class
+            RecordsDraftState.load_records(frontier)
+            for rec in frontier:
+                for _, collected_records in collect_records.send(
+                        record,
+                        record_context=rec,
+                        record=rec,  # back compatibility, deprecated
+                        action=action
+                ):
+                    add_collected_records(collected_records)
+            for _, collected_records in collect_records_batch.send(
                     record,
-                    record_context=rec,
-                    record=rec,  # back compatibility, deprecated
+                    record_contexts=frontier,
                     action=action
             ):
-                # collect_record: RecordContext
-                for collect_record in (collected_records or []):
-                    if collect_record.record_uuid in records_to_publish_map:
-                        continue
-                    records_to_publish_map.add(collect_record.record_uuid)
-                    records_to_publish.append(collect_record)
-                    records_to_publish_queue.append(collect_record)
+                add_collected_records(collected_records)
         return records_to_publish
 
+    @staticmethod
+    def load_records(record_contexts: List[RecordContext]):
+        """
+        Loads records of lazy record contexts (those created only with ``record_pid``)
+        with a single query per record class. Already loaded contexts are left untouched.
+        """
+        contexts_by_class = {}
+        for rc in record_contexts:
+            if not rc.loaded:
+                contexts_by_class.setdefault(rc.record_class, []).append(rc)
+        for record_class, contexts in contexts_by_class.items():
+            records = {
+                record.id: record for record in record_class.get_records(
+                    [rc.record_pid.object_uuid for rc in contexts])
+            }
+            for rc in contexts:
+                rc.record = records.get(rc.record_pid.object_uuid)
+
     def endpoint_for_pid(self, pid):
         return self.endpoint_for_pid_type(pid.pid_type)
 
@@ -158,100 +259,587 @@ class RecordsDraftState:
 
     def publish(
             self, record: Union[RecordContext, Record], record_pid=None,
-            require_valid=True
+            require_valid=True, refresh_policy=None
     ):
         if isinstance(record, Record):
             record = RecordContext(record=record, record_pid=record_pid)
 
-        indices = set()
+        operations = self._indexing_operations(refresh_policy)
 
         with db.session.begin_nested():
             # collect all records to be published (for example, references etc)
             collected_records = self.collect_records_for_action(record, CollectAction.PUBLISH)
+            self.lock_records(collected_records)
 
             # for each collected record, check if can be published
-            for draft_record in collected_records:
-                check_can_publish.send(record, record=draft_record)
-                if 'oarepo:validity' in draft_record.record:
-                    if require_valid and not draft_record.record['oarepo:validity']['valid']:
-                        raise InvalidRecordException('Can not publish invalid record',
-                                                     errors=draft_record.record['oarepo:validity']['errors'])
+            self._check_can_publish(record, collected_records, require_valid)
 
             before_publish.send(collected_records)
 
-            result: List[PublishedDraftRecordPair] = []
+            resolved_pids = self.resolve_paired_pids(collected_records)
+            self.set_url_rewriter(collected_records)
 
-            # publish in reversed order
-            for draft_record_context in reversed(collected_records):
-                draft_pid = draft_record_context.record_pid
-                endpoint = self.endpoint_for_pid_type(draft_pid.pid_type)
-                assert endpoint.published is False
-                published_record_class = endpoint.paired_endpoint.record_class
-                published_record_pid_type = endpoint.paired_endpoint.pid_type
-                published_record, published_pid = self.publish_record_internal(
-                    draft_record_context, published_record_class,
-                    published_record_pid_type, collected_records
-                )
-                published_record_context = RecordContext(record=published_record,
-                                                         record_pid=published_pid)
-                result.append(PublishedDraftRecordPair(
-                    draft_context=draft_record_context,
-                    published_context=published_record_context,
-                    primary=draft_record_context.record == record.record))
-                draft_record_context.published_record_context = published_record_context
-                published_record_context.draft_record_context = draft_record_context
+            result = self._publish_collected_records(record, collected_records, collected_records,
+                                                     resolved_pids=resolved_pids)
 
             after_publish.send(result)
 
-            for rp in result:
-                # delete the record
-                draft_record_context = rp.draft_context
-                published_record_context = rp.published_context
-                draft_record_context.record.delete()
-                draft_indexer = self.indexer_for_record(draft_record_context.record)
-                try:
-                    if draft_indexer and draft_indexer.record_to_index(draft_record_context.record)[0]:
-                        draft_indexer.delete(draft_record_context.record, refresh=True)
-                except:
-                    logger.debug('Error deleting record', draft_record_context.record_pid)
-                    traceback.print_exc()
-
-                published_indexer = self.indexer_for_record(published_record_context.record)
-                if published_indexer and published_indexer.record_to_index(published_record_context.record)[0]:
-                    published_indexer.index(published_record_context.record)
-
-                # mark all object pids as deleted
-                all_pids = PersistentIdentifier.query.filter(
-                    PersistentIdentifier.object_type == draft_record_context.record_pid.object_type,
-                    PersistentIdentifier.object_uuid == draft_record_context.record_pid.object_uuid,
-                ).all()
-                for rec_pid in all_pids:
-                    if not rec_pid.is_deleted():
-                        rec_pid.delete()
-
-                published_record_context.record.commit()
-
-                indices.add(self.index_for_record(published_record_context.record))
-                indices.add(self.index_for_record(draft_record_context.record))
-
-        for index in indices:
-            if not index:
-                continue
-            current_search_client.indices.refresh(index=index)
-            current_search_client.indices.flush(index=index)
+            self._finish_publish(result, operations)
+
+        self._execute(operations)
 
         result.reverse()
         return result
 
-    def edit(self, record: Union[RecordContext, Record], record_pid=None):
+    def publish_many(self, records: List[Union[RecordContext, Record]], require_valid=True,
+                     refresh_policy=None) -> List[PublishManyResult]:
+        """
+        Publishes many draft records in one transaction.
+
+        Records collected for each of the passed records are merged so that a record
+        reachable from several roots is published only once. Paired pids are resolved
+        in batch and the elasticsearch work is done in a single bulk request followed
+        by a single refresh.
+
+        An invalid root (or a root that could not be published) does not abort the whole
+        batch - it is reported in the returned list and its records are left untouched.
+
+        :param records: draft records (or RecordContext instances) to publish
+        :param require_valid: if True, only valid drafts can be published
+        :param refresh_policy: overrides OAREPO_DRAFT_REFRESH_POLICY for this call
+        :return: a list of ``PublishManyResult``, one for each passed record, in the same order
+        """
+        roots = self._record_contexts(records)
+        self.load_records(roots)
+
+        operations = self._indexing_operations(refresh_policy)
+        results: List[PublishManyResult] = []
+
+        with db.session.begin_nested():
+            # collect and check records for each root, merge the collected sets
+            seen = set()
+            accepted = []
+            merged_records = []
+            for root in roots:
+                try:
+                    collected_records = self.collect_records_for_action(root, CollectAction.PUBLISH)
+                    self._check_can_publish(root, collected_records, require_valid)
+                except Exception as e:
+                    results.append(PublishManyResult(record_context=root, ok=False, pairs=[], error=e))
+                    continue
+                own_records = [x for x in collected_records if x.record_uuid not in seen]
+                seen.update(x.record_uuid for x in own_records)
+                merged_records.extend(own_records)
+                accepted.append((len(results), own_records, collected_records))
+                results.append(PublishManyResult(record_context=root, ok=True, pairs=[], error=None))
+
+            locked_out = self._lock_records(merged_records)
+            if locked_out:
+                accepted = self._reject_locked_roots(accepted, results, locked_out)
+                merged_records = [x for _, own_records, _ in accepted for x in own_records]
+
+            before_publish.send(merged_records)
+
+            resolved_pids = self.resolve_paired_pids(merged_records)
+            self.set_url_rewriter(merged_records)
+
+            all_pairs: List[PublishedDraftRecordPair] = []
+            published_uuids = set()
+            for result_idx, own_records, collected_records in accepted:
+                result = results[result_idx]
+                try:
+                    own_uuids = {x.record_uuid for x in own_records}
+                    unpublished = [
+                        str(x.record_pid) for x in collected_records
+                        if x.record_uuid not in own_uuids and x.record_uuid not in published_uuids
+                    ]
+                    if unpublished:
+                        raise InvalidRecordException('Can not publish record, linked records '
+                                                     'could not be published',
+                                                     errors={'other': unpublished})
+                    # each root in its own savepoint so that a failure does not affect other roots
+                    with db.session.begin_nested():
+                        pairs = self._publish_collected_records(
+                            result.record_context, own_records, collected_records,
+                            resolved_pids=resolved_pids)
+                except Exception as e:
+                    logger.debug('Error publishing record %s', result.record_context.record_pid, exc_info=True)
+                    results[result_idx] = result._replace(ok=False, error=e)
+                else:
+                    results[result_idx] = result._replace(pairs=list(reversed(pairs)))
+                    published_uuids.update(own_uuids)
+                    all_pairs.extend(pairs)
+
+            after_publish.send(all_pairs)
+
+            self._finish_publish(all_pairs, operations)
+
+        self._execute(operations)
+
+        return results
+
+    @staticmethod
+    def _reject_locked_roots(accepted, results, locked_out):
+        """
+        Roots of ``publish_many`` touching a record locked by another action are reported
+        with ``RecordLockedException``, the rest is published.
+
+        :return: the accepted roots that do not touch any locked record
+        """
+        still_accepted = []
+        for result_idx, own_records, collected_records in accepted:
+            if any(x.record_uuid in locked_out for x in collected_records):
+                results[result_idx] = results[result_idx]._replace(ok=False, error=RecordLockedException())
+            else:
+                still_accepted.append((result_idx, own_records, collected_records))
+        return still_accepted
+
+    def publish_chunked(self, record: Union[RecordContext, Record], record_pid=None,
+                        require_valid=True, chunk_size=None, run=True, user_id=None) -> DraftPublishJob:
+        """
+        Publishes a (possibly very large) graph of records in chunks, each chunk in its own
+        database transaction. The collected records are stored in a ``DraftPublishJob`` together
+        with a cursor of already published records, so the publishing can be resumed
+        via ``run_publish_job`` after a failure. The root record is published last,
+        in the last chunk.
+
+        Note that this method commits the database session.
+
+        The records are checked (validity and ``check_can_publish``) when the job is created
+        and again before each chunk is published, as the drafts might have changed meanwhile.
+        ``check_can_publish``, ``before_publish`` and ``after_publish`` receivers get only
+        the records of the chunk being published, ``collected_records`` of the record-level signals
+        are the records of the chunk as well.
+
+        :param record: the root draft record (or its RecordContext)
+        :param require_valid: if True, all collected drafts must be valid
+        :param chunk_size: number of records published in one transaction,
+                           defaults to ``OAREPO_DRAFT_PUBLISH_CHUNK_SIZE``
+        :param run: if False, the job is only created and should be run later (for example by a worker)
+        :param user_id: id of the user who started the job, only this user can see the job's status via REST API
+        :return: the publish job
+        """
         if isinstance(record, Record):
             record = RecordContext(record=record, record_pid=record_pid)
 
-        indices = set()
+        with db.session.begin_nested():
+            collected_records = self.collect_records_for_action(record, CollectAction.PUBLISH)
+            self._check_can_publish(record, collected_records, require_valid)
+            job = DraftPublishJob(
+                status=PUBLISH_JOB_PENDING,
+                pid_type=record.record_pid.pid_type,
+                pid_value=record.record_pid.pid_value,
+                # dependencies first, root last
+                records=[[rc.record_pid.pid_type, rc.record_pid.pid_value]
+                         for rc in reversed(collected_records)],
+                cursor=0,
+                total=len(collected_records),
+                chunk_size=chunk_size or self.app.config['OAREPO_DRAFT_PUBLISH_CHUNK_SIZE'],
+                # urls are built here as the job's worker might run outside of a request
+                urls=[list(urls) for urls in filter(None, (
+                    self._record_urls(rc.record_pid.pid_type, rc.record_pid.pid_value) for rc in collected_records
+                ))],
+                require_valid=require_valid,
+                user_id=str(user_id) if user_id is not None else None
+            )
+            db.session.add(job)
+        db.session.commit()
+
+        if run:
+            self.run_publish_job(job)
+        return job
+
+    def run_publish_job(self, job: DraftPublishJob, refresh_policy=None) -> DraftPublishJob:
+        """
+        Publishes the remaining records of a publish job, chunk by chunk. Each chunk is published
+        and the job's cursor moved in one transaction which is committed before the next chunk.
+        Elasticsearch is updated after each commit. If a chunk fails, it is rolled back
+        and the job is marked as failed; running the job again resumes it from the failed chunk.
+
+        :return: the job
+        """
+        job.status = PUBLISH_JOB_RUNNING
+        job.heartbeat = datetime.datetime.utcnow()
+        job.error = None
+        db.session.commit()
+
+        if job.urls is not None:
+            url_rewriter = UrlRewriter(job.urls)
+        else:
+            url_rewriter = UrlRewriter(filter(None, (
+                self._record_urls(pid_type, pid_value) for pid_type, pid_value in job.records)))
+
+        while job.cursor < job.total:
+            chunk = job.records[job.cursor:job.cursor + job.chunk_size]
+            operations = IndexingOperations(refresh_policy=refresh_policy)
+            try:
+                with db.session.begin_nested():
+                    self._publish_job_chunk(job, chunk, url_rewriter, operations)
+                    if self.app.config['OAREPO_DRAFT_INDEXING_OUTBOX']:
+                        # outbox entries must be written in the transaction of the chunk
+                        operations.execute(use_queue=False)
+                    job.cursor = job.cursor + len(chunk)
+                    job.heartbeat = datetime.datetime.utcnow()
+                    if job.cursor >= job.total:
+                        job.status = PUBLISH_JOB_COMPLETED
+                db.session.commit()
+            except Exception as e:
+                logger.exception('Error publishing chunk of publish job %s', job.id)
+                db.session.rollback()
+                job.status = PUBLISH_JOB_FAILED
+                job.error = str(e)
+                db.session.commit()
+                return job
+            operations.execute(use_queue=False)
+        return job
+
+    def claim_publish_job(self, job_id=None, resume_failed=False) -> Optional[DraftPublishJob]:
+        """
+        Claims a publish job for execution - the job row is locked with ``SKIP LOCKED`` (so concurrent
+        workers never claim the same job), marked as running and the session is committed.
+        Pending jobs and running jobs that have not reported progress for ``OAREPO_DRAFT_PUBLISH_JOB_LEASE``
+        seconds (their worker has crashed) can be claimed. Failed jobs only if ``resume_failed`` is set.
+
+        :param job_id: claim this job, otherwise the oldest claimable job is claimed
+        :param resume_failed: claim also failed jobs
+        :return: the claimed job or None if there is no job to claim
+        """
+        expired = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.app.config['OAREPO_DRAFT_PUBLISH_JOB_LEASE'])
+        statuses = [PUBLISH_JOB_PENDING]
+        if resume_failed:
+            statuses.append(PUBLISH_JOB_FAILED)
+        query = DraftPublishJob.query.filter(or_(
+            DraftPublishJob.status.in_(statuses),
+            and_(DraftPublishJob.status == PUBLISH_JOB_RUNNING,
+                 or_(DraftPublishJob.heartbeat.is_(None), DraftPublishJob.heartbeat < expired))
+        ))
+        if job_id:
+            query = query.filter(DraftPublishJob.id == job_id)
+        job = query.order_by(DraftPublishJob.created).with_for_update(skip_locked=True).first()
+        if job is not None:
+            job.status = PUBLISH_JOB_RUNNING
+            job.heartbeat = datetime.datetime.utcnow()
+        db.session.commit()
+        return job
+
+    def run_pending_publish_jobs(self):
+        """
+        Claims and runs pending (or abandoned) publish jobs until there is nothing left to claim.
+
+        :return: the executed jobs
+        """
+        executed = []
+        while True:
+            job = self.claim_publish_job()
+            if job is None:
+                return executed
+            self.run_publish_job(job)
+            executed.append(job)
+
+    def _publish_job_chunk(self, job: DraftPublishJob, chunk, url_rewriter, operations):
+        # drafts that no longer exist (for example, published meanwhile by someone else) are skipped
+        registered_pids = {
+            (pid.pid_type, pid.pid_value): pid for pid in PersistentIdentifier.query.filter(
+                or_(*[
+                    and_(PersistentIdentifier.pid_type == pid_type,
+                         PersistentIdentifier.pid_value == pid_value)
+                    for pid_type, pid_value in chunk
+                ]),
+                PersistentIdentifier.status == PIDStatus.REGISTERED
+            )
+        }
+        chunk_records = [
+            RecordContext(record_pid=registered_pids[(pid_type, pid_value)], url_rewriter=url_rewriter)
+            for pid_type, pid_value in chunk
+            if (pid_type, pid_value) in registered_pids
+        ]
+        self.load_records(chunk_records)
+        self.lock_records(chunk_records)
+        root = next((
+            rc for rc in chunk_records
+            if (rc.record_pid.pid_type, rc.record_pid.pid_value) == (job.pid_type, job.pid_value)
+        ), None)
+        if root is None:
+            # the root record is published in the last chunk, until then it is only the sender of signals
+            root = RecordContext(record_pid=PersistentIdentifier.query.filter_by(
+                pid_type=job.pid_type, pid_value=job.pid_value, status=PIDStatus.REGISTERED).one_or_none())
+
+        # the drafts might have been changed since the job was created
+        self._check_can_publish(root, chunk_records, job.require_valid)
+
+        before_publish.send(chunk_records)
+        resolved_pids = self.resolve_paired_pids(chunk_records)
+        # records in chunk are already in the publishing order, _publish_collected_records reverses it
+        result = self._publish_collected_records(root, list(reversed(chunk_records)), chunk_records,
+                                                 resolved_pids=resolved_pids)
+        after_publish.send(result)
+        self._finish_publish(result, operations)
+
+    def lock_records(self, record_contexts: List[RecordContext]):
+        """
+        Locks database rows of the records (``SELECT ... FOR UPDATE``), ordered by table and uuid
+        so that concurrent actions on overlapping sets of records can not deadlock.
+        See ``OAREPO_DRAFT_RECORD_LOCKING``.
+
+        Raises ``RecordLockedException`` if some of the rows are locked by another transaction
+        (in ``nowait`` mode) or if some of the records have been modified since they were loaded
+        (for example, published by a concurrent request that has just released the lock).
+        """
+        if self._lock_records(record_contexts):
+            raise RecordLockedException()
+
+    def _lock_records(self, record_contexts: List[RecordContext]):
+        """
+        Locks database rows of the records as ``lock_records`` does.
+
+        :return: a set of uuids of records that could not be locked or have been modified since loaded
+        """
+        mode = self.app.config['OAREPO_DRAFT_RECORD_LOCKING']
+        failed = set()
+        if not mode:
+            return failed
+        contexts_by_model = {}
+        for rc in record_contexts:
+            model = rc.record.model
+            contexts_by_model.setdefault(type(model), {})[model.id] = rc
+        for model_cls in sorted(contexts_by_model, key=lambda x: x.__tablename__):
+            contexts = contexts_by_model[model_cls]
+            locked = dict(db.session.query(model_cls.id, model_cls.version_id).filter(
+                model_cls.id.in_(list(contexts))
+            ).order_by(model_cls.id).with_for_update(skip_locked=(mode == 'nowait')).all())
+            failed.update(
+                record_id for record_id, rc in contexts.items()
+                if locked.get(record_id) != rc.record.model.version_id
+            )
+        return failed
+
+    def _record_contexts(self, records: List[Union[RecordContext, Record]]) -> List[RecordContext]:
+        """
+        Converts records to record contexts, looking up persistent identifiers
+        of the records in a single query.
+        """
+        record_uuids = [record.id for record in records if isinstance(record, Record)]
+        pids = {}
+        if record_uuids:
+            for pid in PersistentIdentifier.query.filter(
+                    PersistentIdentifier.object_type == 'rec',
+                    PersistentIdentifier.object_uuid.in_(record_uuids)):
+                pids[(pid.pid_type, pid.object_uuid)] = pid
+        ret = []
+        for record in records:
+            if isinstance(record, Record):
+                endpoint = self.endpoint_for_record(record)
+                record = RecordContext(record=record,
+                                       record_pid=pids.get((endpoint.pid_type, record.id)))
+            ret.append(record)
+        return ret
+
+    def _check_can_publish(self, record: RecordContext, collected_records: List[RecordContext], require_valid):
+        for draft_record in collected_records:
+            check_can_publish.send(record, record=draft_record)
+            if 'oarepo:validity' in draft_record.record:
+                if require_valid and not draft_record.record['oarepo:validity']['valid']:
+                    raise InvalidRecordException('Can not publish invalid record',
+                                                 errors=draft_record.record['oarepo:validity']['errors'])
+
+    def _publish_collected_records(self, record: RecordContext, records_to_publish: List[RecordContext],
+                                   collected_records: List[RecordContext], resolved_pids=None):
+        result: List[PublishedDraftRecordPair] = []
+
+        # publish in reversed order
+        for draft_record_context in reversed(records_to_publish):
+            draft_pid = draft_record_context.record_pid
+            endpoint = self.endpoint_for_pid_type(draft_pid.pid_type)
+            assert endpoint.published is False
+            published_record_class = endpoint.paired_endpoint.record_class
+            published_record_pid_type = endpoint.paired_endpoint.pid_type
+            published_record, published_pid = self.publish_record_internal(
+                draft_record_context, published_record_class,
+                published_record_pid_type, collected_records,
+                resolved_pids=resolved_pids
+            )
+            published_record_context = RecordContext(record=published_record,
+                                                     record_pid=published_pid)
+            result.append(PublishedDraftRecordPair(
+                draft_context=draft_record_context,
+                published_context=published_record_context,
+                primary=draft_record_context.record == record.record))
+            draft_record_context.published_record_context = published_record_context
+            published_record_context.draft_record_context = draft_record_context
+        return result
+
+    def _finish_publish(self, result: List[PublishedDraftRecordPair], operations: IndexingOperations):
+        for rp in result:
+            # delete the record
+            draft_record_context = rp.draft_context
+            published_record_context = rp.published_context
+            operations.delete(draft_record_context.record, draft_record_context)
+            draft_record_context.record.delete()
+            if draft_record_context.paired_record_unchanged:
+                # no new revision nor reindexing if the content has not changed
+                continue
+            operations.index(published_record_context.record, published_record_context)
+
+            published_record_context.record.commit()
+
+        # mark all object pids as deleted
+        self._delete_object_pids([rp.draft_context.record_pid for rp in result])
+
+    @contextlib.contextmanager
+    def batch(self, refresh_policy=None):
+        """
+        Groups draft actions (publish, edit, unpublish, ...) called inside the block. Elasticsearch
+        operations, index refreshes and pid deletions of all the actions are deferred and performed
+        at once when the block exits. If the block raises an exception, the deferred work is discarded.
+        Nested blocks join the outermost one.
+
+        Commit the database session after the block exits.
+
+        :param refresh_policy: refresh policy for all the actions inside the block
+        """
+        batch = get_draft_batch()
+        if batch is not None:
+            yield batch
+            return
+        batch = g.oarepo_draft_batch = DraftBatch(refresh_policy=refresh_policy)
+        try:
+            yield batch
+        finally:
+            g.pop('oarepo_draft_batch', None)
+        batch.flush()
+
+    @staticmethod
+    def _indexing_operations(refresh_policy):
+        batch = get_draft_batch()
+        if batch is not None:
+            return batch.operations
+        return IndexingOperations(refresh_policy=refresh_policy)
+
+    @staticmethod
+    def _execute(operations: IndexingOperations):
+        batch = get_draft_batch()
+        if batch is not None and batch.operations is operations:
+            return  # executed when the batch exits
+        operations.execute()
+
+    def _delete_object_pids(self, pids: List[PersistentIdentifier]):
+        batch = get_draft_batch()
+        if batch is not None:
+            batch.delete_pids(pids)
+        else:
+            self.delete_object_pids(pids)
+
+    @staticmethod
+    def delete_object_pids(pids: List[PersistentIdentifier], exclude=()):
+        """
+        Deletes all persistent identifiers of the objects the passed pids point to, with the semantics
+        of ``PersistentIdentifier.delete``: pids in the ``NEW`` state are removed, other ones are
+        marked as ``DELETED``. This is done in two set-based statements regardless of the number of pids.
+
+        :param pids: persistent identifiers of the deleted records
+        :param exclude: ids of persistent identifiers that should be left untouched
+        """
+        uuids_by_type = {}
+        for pid in pids:
+            uuids_by_type.setdefault(pid.object_type, set()).add(pid.object_uuid)
+        if not uuids_by_type:
+            return
+        objects_filter = or_(*[
+            and_(
+                PersistentIdentifier.object_type == object_type,
+                PersistentIdentifier.object_uuid.in_(object_uuids)
+            ) for object_type, object_uuids in uuids_by_type.items()
+        ])
+        if exclude:
+            objects_filter = and_(objects_filter, PersistentIdentifier.id.notin_(list(exclude)))
+        PersistentIdentifier.query.filter(
+            objects_filter,
+            PersistentIdentifier.status == PIDStatus.NEW
+        ).delete(synchronize_session='fetch')
+        PersistentIdentifier.query.filter(
+            objects_filter,
+            PersistentIdentifier.status != PIDStatus.DELETED
+        ).update({PersistentIdentifier.status: PIDStatus.DELETED}, synchronize_session='fetch')
+
+    def resolve_paired_pids(self, record_contexts: List[RecordContext]):
+        """
+        Resolves persistent identifiers of the paired (draft <-> published) records
+        of the passed record contexts in a single query. The status of the returned pids
+        tells if the paired record exists (registered) or has been deleted.
+
+        :param record_contexts: contexts of draft or published records
+        :return: a dictionary (paired pid type, pid value) => PersistentIdentifier. Pids
+                 that do not exist are not present in the dictionary.
+        """
+        values_by_type = {}
+        for rc in record_contexts:
+            paired_endpoint = self.endpoint_for_pid_type(rc.record_pid.pid_type).paired_endpoint
+            values_by_type.setdefault(paired_endpoint.pid_type, set()).add(rc.record_pid.pid_value)
+        if not values_by_type:
+            return {}
+        pids = PersistentIdentifier.query.filter(or_(*[
+            and_(
+                PersistentIdentifier.pid_type == pid_type,
+                PersistentIdentifier.pid_value.in_(pid_values)
+            ) for pid_type, pid_values in values_by_type.items()
+        ])).all()
+        batch = get_draft_batch()
+        if batch is not None:
+            for pid in pids:
+                batch.apply_deleted_pid(pid)
+        return {
+            (pid.pid_type, pid.pid_value): pid for pid in pids
+        }
+
+    def set_url_rewriter(self, record_contexts: List[RecordContext]):
+        """
+        Fills ``draft_record_url`` and ``published_record_url`` of the passed record contexts
+        and sets their ``url_rewriter`` to a rewriter shared by the whole set. The rewriter turns
+        urls of the records (and urls below them, such as file urls) into urls of the paired records.
+        Records whose urls can not be built (for example, outside of a request without
+        ``SERVER_NAME``) are skipped.
+        """
+        url_pairs = []
+        for rc in record_contexts:
+            urls = self._record_urls(rc.record_pid.pid_type, rc.record_pid.pid_value)
+            if not urls:
+                continue
+            source_url, target_url = urls
+            if self.endpoint_for_pid_type(rc.record_pid.pid_type).published:
+                rc.published_record_url, rc.draft_record_url = source_url, target_url
+            else:
+                rc.draft_record_url, rc.published_record_url = source_url, target_url
+            url_pairs.append((source_url, target_url))
+        url_rewriter = UrlRewriter(url_pairs)
+        for rc in record_contexts:
+            rc.url_rewriter = url_rewriter
+
+    def _record_urls(self, pid_type, pid_value):
+        """
+        Returns (url of the record, url of the paired record) or None if the urls can not be built
+        """
+        endpoint = self.endpoint_for_pid_type(pid_type)
+        try:
+            return (
+                url_for('invenio_records_rest.{0}_item'.format(endpoint.rest_name),
+                        pid_value=pid_value, _external=True),
+                url_for('invenio_records_rest.{0}_item'.format(endpoint.paired_endpoint.rest_name),
+                        pid_value=pid_value, _external=True)
+            )
+        except (BuildError, RuntimeError):
+            return None
+
+    def edit(self, record: Union[RecordContext, Record], record_pid=None, refresh_policy=None):
+        if isinstance(record, Record):
+            record = RecordContext(record=record, record_pid=record_pid)
+
+        operations = self._indexing_operations(refresh_policy)
 
         with db.session.begin_nested():
             # collect all records to be draft (for example, references etc)
             collected_records = self.collect_records_for_action(record, CollectAction.EDIT)
+            self.lock_records(collected_records)
 
             # for each collected record, check if can be draft
             for published_record in collected_records:
@@ -259,6 +847,9 @@ class RecordsDraftState:
 
             before_edit.send(collected_records)
 
+            resolved_pids = self.resolve_paired_pids(collected_records)
+            self.set_url_rewriter(collected_records)
+
             result: List[PublishedDraftRecordPair] = []
             # publish in reversed order
             for published_record_context in reversed(collected_records):
@@ -266,11 +857,12 @@ class RecordsDraftState:
                 endpoint = self.endpoint_for_pid_type(published_pid.pid_type)
                 assert endpoint.published
                 draft_record_class = endpoint.paired_endpoint.record_class
-                draft_record_pid_type = endpoint.paired_endpoint.rest_name
+                draft_record_pid_type = endpoint.paired_endpoint.pid_type
                 draft_record, draft_pid = self.draft_record_internal(
                     published_record_context, published_pid,
                     draft_record_class, draft_record_pid_type,
-                    collected_records
+                    collected_records,
+                    resolved_pids=resolved_pids
                 )
                 draft_record_context = RecordContext(record=draft_record, record_pid=draft_pid)
                 result.append(PublishedDraftRecordPair(
@@ -284,34 +876,27 @@ class RecordsDraftState:
             after_edit.send(result)
 
             for rp in result:
-                published_record_context = rp.published_context
+                if rp.published_context.paired_record_unchanged:
+                    continue
                 draft_record_context = rp.draft_context
                 draft_record_context.record.commit()
-                draft_indexer = self.indexer_for_record(draft_record_context.record)
-                if draft_indexer and draft_indexer.record_to_index(draft_record_context.record)[0]:
-                    draft_indexer.index(draft_record_context.record)
-
-                indices.add(self.index_for_record(published_record_context.record))
-                indices.add(self.index_for_record(draft_record_context.record))
+                operations.index(draft_record_context.record, draft_record_context)
 
-        for index in indices:
-            if not index:
-                continue
-            current_search_client.indices.refresh(index=index)
-            current_search_client.indices.flush(index=index)
+        self._execute(operations)
 
         result.reverse()
         return result
 
-    def unpublish(self, record: Union[RecordContext, Record], record_pid=None):
+    def unpublish(self, record: Union[RecordContext, Record], record_pid=None, refresh_policy=None):
         if isinstance(record, Record):
             record = RecordContext(record=record, record_pid=record_pid)
 
-        indices = set()
+        operations = self._indexing_operations(refresh_policy)
 
         with db.session.begin_nested():
             # collect all records to be draft (for example, references etc)
             collected_records = self.collect_records_for_action(record, CollectAction.UNPUBLISH)
+            self.lock_records(collected_records)
 
             # for each collected record, check if can be draft
             for published_record in collected_records:
@@ -319,6 +904,9 @@ class RecordsDraftState:
 
             before_unpublish.send(collected_records)
 
+            resolved_pids = self.resolve_paired_pids(collected_records)
+            self.set_url_rewriter(collected_records)
+
             result: List[PublishedDraftRecordPair] = []
             # publish in reversed order
             for published_record_context in reversed(collected_records):
@@ -330,7 +918,8 @@ class RecordsDraftState:
                 draft_record, draft_pid = self.draft_record_internal(
                     published_record_context, published_pid,
                     draft_record_class, draft_record_pid_type,
-                    collected_records
+                    collected_records,
+                    resolved_pids=resolved_pids
                 )
                 draft_record_context = RecordContext(record=draft_record, record_pid=draft_pid)
                 result.append(PublishedDraftRecordPair(
@@ -347,36 +936,18 @@ class RecordsDraftState:
                 published_record_context = rp.published_context
                 draft_record_context = rp.draft_context
                 # delete the record
+                operations.delete(published_record_context.record, published_record_context)
                 published_record_context.record.delete()
-                published_indexer = self.indexer_for_record(published_record_context.record)
-                try:
-                    if published_indexer and published_indexer.record_to_index(published_record_context.record)[0]:
-                        RecordIndexer().delete(published_record_context.record, refresh=True)
-                except:
-                    logger.debug('Error deleting record', published_record_context.record_pid)
-                    traceback.print_exc()
 
+                if published_record_context.paired_record_unchanged:
+                    continue
                 draft_record_context.record.commit()
-                draft_indexer = self.indexer_for_record(draft_record_context.record)
-                if draft_indexer and draft_indexer.record_to_index(draft_record_context.record)[0]:
-                    draft_indexer.index(draft_record_context.record)
-                # mark all object pids as deleted
-                all_pids = PersistentIdentifier.query.filter(
-                    PersistentIdentifier.object_type == published_record_context.record_pid.object_type,
-                    PersistentIdentifier.object_uuid == published_record_context.record_pid.object_uuid,
-                ).all()
-                for rec_pid in all_pids:
-                    if not rec_pid.is_deleted():
-                        rec_pid.delete()
-
-                indices.add(self.index_for_record(published_record_context.record))
-                indices.add(self.index_for_record(draft_record_context.record))
-
-        for index in indices:
-            if not index:
-                continue
-            current_search_client.indices.refresh(index=index)
-            current_search_client.indices.flush(index=index)
+                operations.index(draft_record_context.record, draft_record_context)
+
+            # mark all object pids as deleted
+            self._delete_object_pids([rp.published_context.record_pid for rp in result])
+
+        self._execute(operations)
 
         result.reverse()
         return result
@@ -384,25 +955,28 @@ class RecordsDraftState:
     def publish_record_internal(self, record_context,
                                 published_record_class,
                                 published_pid_type,
-                                collected_records):
+                                collected_records,
+                                resolved_pids=None):
         draft_record = record_context.record
         draft_pid = record_context.record_pid
 
         # clone metadata
-        metadata = copy.deepcopy(dict(draft_record))
-        if 'oarepo:validity' in metadata:
-            del metadata['oarepo:validity']
-        metadata.pop('oarepo:draft', True)
+        metadata = clone_metadata(draft_record, exclude=('oarepo:validity', 'oarepo:draft'))
 
-        try:
-            published_pid = PersistentIdentifier.get(published_pid_type, draft_pid.pid_value)
-        except PIDDoesNotExistError:
-            published_pid = None
+        if resolved_pids is not None:
+            published_pid = resolved_pids.get((published_pid_type, draft_pid.pid_value))
+        else:
+            try:
+                published_pid = PersistentIdentifier.get(published_pid_type, draft_pid.pid_value)
+            except PIDDoesNotExistError:
+                published_pid = None
 
         before_publish_record.send(draft_record, metadata=metadata,
                                    record_context=record_context,
                                    record=record_context,  # back compatibility, deprecated
                                    collected_records=collected_records)
+        if record_context.url_rewriter:
+            record_context.url_rewriter.rewrite(metadata)
 
         if published_pid:
             if published_pid.status == PIDStatus.DELETED:
@@ -466,53 +1040,155 @@ class RecordsDraftState:
         draft_by_key = {
             x['key']: x for x in source_record.get('_files', [])
         }
+        target_bucket = target_record.bucket
+        if target_bucket.locked:
+            raise BucketLockedError()
+
+        batch_size = self.app.config['OAREPO_DRAFT_FILE_COPY_BATCH_SIZE']
         published_files = []
-        for ov in ObjectVersion.get_by_bucket(bucket=source_record.bucket):
-            file_md = copy.copy(draft_by_key.get(ov.key, {}))
-            if self._copy_file(source_record, ov, target_record, file_md,
-                               source_record_context, target_record_context):
-                published_files.append(file_md)
+        batch = []
+        source_versions = ObjectVersion.get_by_bucket(bucket=source_record.bucket). \
+            options(joinedload(ObjectVersion.file)).yield_per(batch_size)
+        for ov in source_versions:
+            batch.append(ov)
+            if len(batch) >= batch_size:
+                published_files.extend(self._copy_files_batch(
+                    batch, draft_by_key, source_record, target_record,
+                    source_record_context, target_record_context))
+                batch = []
+        if batch:
+            published_files.extend(self._copy_files_batch(
+                batch, draft_by_key, source_record, target_record,
+                source_record_context, target_record_context))
         target_record['_files'] = published_files
 
-    def _copy_file(self, source_record, ov, target_record, file_md,
-                   source_record_context, target_record_context):
-        bucket = target_record.bucket
-        new_ob = ObjectVersion.create(
-            bucket,
-            ov.key,
-            _file_id=ov.file_id
-        )
-
-        tags = {tag.key: tag.value for tag in ov.tags}
-        for _, res in file_copied.send(
-                source_record, source_record=source_record,
-                target_record=target_record, object_version=ov,
-                tags=tags, metadata=file_md,
-                source_record_context=source_record_context,
-                target_record_context=target_record_context):
-            if res is False:
-                return False  # skip this file
-
-        for key, value in tags:
-            ObjectVersionTag.create_or_update(
-                object_version=new_ob,
-                key=key,
-                value=value)
-
-        file_md['bucket'] = str(bucket.id)
-        file_md['file_id'] = str(new_ob.file_id)
-        file_md['version_id'] = str(new_ob.version_id)
+    def _copy_files_batch(self, object_versions, draft_by_key, source_record, target_record,
+                          source_record_context, target_record_context):
+        """
+        Copies a batch of object versions to the bucket of the target record. ``file_copied``
+        receivers are called for each file, then the new object versions and their tags are
+        inserted with two bulk statements.
+
+        :return: file metadata of the copied files
+        """
+        target_bucket = target_record.bucket
+        tags_by_version = {}
+        for tag in ObjectVersionTag.query.filter(
+                ObjectVersionTag.version_id.in_([ov.version_id for ov in object_versions])):
+            tags_by_version.setdefault(tag.version_id, {})[tag.key] = tag.value
+
+        copied_files = []
+        new_versions = []
+        new_tags = []
+        size = 0
+        for ov in object_versions:
+            file_md = copy.copy(draft_by_key.get(ov.key, {}))
+            tags = tags_by_version.get(ov.version_id, {})
+            skipped = False
+            for _, res in file_copied.send(
+                    source_record, source_record=source_record,
+                    target_record=target_record, object_version=ov,
+                    tags=tags, metadata=file_md,
+                    source_record_context=source_record_context,
+                    target_record_context=target_record_context,
+                    url_rewriter=source_record_context.url_rewriter):
+                if res is False:
+                    skipped = True  # skip this file
+                    break
+            if skipped:
+                continue
 
-        return True
+            version_id = uuid.uuid4()
+            new_versions.append(dict(
+                version_id=version_id,
+                key=ov.key,
+                bucket_id=target_bucket.id,
+                file_id=ov.file_id,
+                _mimetype=ov._mimetype,
+                is_head=True
+            ))
+            new_tags.extend(
+                dict(version_id=version_id, key=key, value=value)
+                for key, value in tags.items()
+            )
+            size += ov.file.size
+
+            file_md['bucket'] = str(target_bucket.id)
+            file_md['file_id'] = str(ov.file_id)
+            file_md['version_id'] = str(version_id)
+            copied_files.append(file_md)
+
+        if not new_versions:
+            return copied_files
+
+        # the copied files become new heads in the target bucket
+        ObjectVersion.query.filter(
+            ObjectVersion.bucket_id == target_bucket.id,
+            ObjectVersion.key.in_([v['key'] for v in new_versions]),
+            ObjectVersion.is_head.is_(True)
+        ).update({ObjectVersion.is_head: False}, synchronize_session='fetch')
+        db.session.bulk_insert_mappings(ObjectVersion, new_versions)
+        if new_tags:
+            db.session.bulk_insert_mappings(ObjectVersionTag, new_tags)
+        target_bucket.size += size
+        db.session.add(target_bucket)
+
+        return copied_files
 
     def index_for_record(self, record):
         indexer: RecordIndexer = self.indexer_for_record(record)
         if not indexer:
             return None
-        index, doctype = indexer.record_to_index(record)
-        if not index:
-            return None
-        return indexer._prepare_index(index, doctype)[0]
+        return record_index(indexer, record)[0]
+
+    @staticmethod
+    def _last_live_revision(record):
+        """
+        Returns the record with metadata of its last non-deleted revision, looked up
+        with a single query on the version table. The metadata are restored on the model
+        as well (``Record.commit`` refuses to commit a deleted model), they are stored
+        in one revision when the record is committed.
+        """
+        model = record.model
+        version_cls = version_class(model.__class__)
+        version = version_cls.query.filter(
+            version_cls.id == model.id,
+            version_cls.json.isnot(None),
+            # some databases store the json of the deleted revision as an empty object instead of NULL
+            cast(version_cls.json, Text) != '{}'
+        ).order_by(version_cls.transaction_id.desc()).limit(1).first()
+        if version is None:
+            return record
+        model.json = dict(version.json)
+        flag_modified(model, 'json')
+        return record.__class__(dict(version.json), model=model)
+
+    def _same_content(self, metadata, source_record, target_record):
+        """
+        Returns True if copying the metadata and files of the source record would not change the target record.
+        Tags of the files are compared as well as they are not part of the ``_files`` metadata.
+        """
+        if not same_content(metadata, target_record):
+            return False
+        return self._file_tags(source_record) == self._file_tags(target_record)
+
+    @staticmethod
+    def _file_tags(record):
+        """
+        Returns tags of the head file versions of the record's bucket as {file key: {tag key: value}}
+        """
+        bucket_id = record.bucket_id if hasattr(record, 'bucket') else None
+        if not bucket_id:
+            return {}
+        tags = {}
+        for file_key, tag_key, value in db.session.query(
+                ObjectVersion.key, ObjectVersionTag.key, ObjectVersionTag.value
+        ).join(ObjectVersionTag, ObjectVersionTag.version_id == ObjectVersion.version_id).filter(
+            ObjectVersion.bucket_id == bucket_id,
+            ObjectVersion.is_head.is_(True)
+        ):
+            tags.setdefault(file_key, {})[tag_key] = value
+        return tags
 
     def _update_published_record(self, published_pid, metadata,
                                  timestamp, published_record_class,
@@ -521,10 +1197,15 @@ class RecordsDraftState:
             published_pid.object_uuid, with_deleted=True)
         # if deleted, revert to last non-deleted revision
         if published_record.model.json is None:
-            revision_id = published_record.revision_id
-            while published_record.model.json is None and revision_id > 0:
-                revision_id -= 1
-                published_record = published_record.revert(revision_id)
+            published_record = self._last_live_revision(published_record)
+
+        if timestamp and self._same_content(metadata, draft_record_context.record, published_record):
+            # nothing to do, published record already has the same content
+            draft_record_context.paired_record_unchanged = True
+            after_publish_record.send(published_record,
+                                      published_record=published_record,
+                                      published_pid=published_pid)
+            return published_record, published_pid
 
         if not timestamp or published_record.updated < timestamp:
             # do not propagate bucket and files as these have incorrect
@@ -553,17 +1234,26 @@ class RecordsDraftState:
         return published_record, published_pid
 
     def draft_record_internal(self, published_record_context, published_pid,
-                              draft_record_class, draft_pid_type, collected_records):
-        metadata = copy.deepcopy(dict(published_record_context.record))
+                              draft_record_class, draft_pid_type, collected_records,
+                              resolved_pids=None):
+        metadata = clone_metadata(published_record_context.record)
 
         before_unpublish_record.send(published_record_context.record, metadata=metadata,
                                      record_context=published_record_context,
                                      record=published_record_context,  # back compatibility, deprecated
                                      collected_records=collected_records)
+        if published_record_context.url_rewriter:
+            published_record_context.url_rewriter.rewrite(metadata)
 
-        try:
-            draft_pid = PersistentIdentifier.get(draft_pid_type, published_pid.pid_value)
+        if resolved_pids is not None:
+            draft_pid = resolved_pids.get((draft_pid_type, published_pid.pid_value))
+        else:
+            try:
+                draft_pid = PersistentIdentifier.get(draft_pid_type, published_pid.pid_value)
+            except PIDDoesNotExistError:
+                draft_pid = None
 
+        if draft_pid:
             if draft_pid.status == PIDStatus.DELETED:
                 # the draft is deleted, resurrect it
                 # change the pid to registered
@@ -587,8 +1277,6 @@ class RecordsDraftState:
             raise NotImplementedError('Can not unpublish record to draft record '
                                       'with pid status %s. Only registered or deleted '
                                       'statuses are implemented', draft_pid.status)
-        except PIDDoesNotExistError:
-            pass
 
         # create a new draft record. Do not call minter as the pid value will be the
         # same as the pid value of the published record
@@ -616,10 +1304,13 @@ class RecordsDraftState:
                                                      with_deleted=True)
 
         # if deleted, revert to last non-deleted revision
-        revision_id = draft_record.revision_id
-        while draft_record.model.json is None and revision_id > 0:
-            revision_id -= 1
-            draft_record = draft_record.revert(revision_id)
+        if draft_record.model.json is None:
+            draft_record = self._last_live_revision(draft_record)
+
+        if timestamp and self._same_content(metadata, published_record_context.record, draft_record):
+            # nothing to do, draft record already has the same content
+            published_record_context.paired_record_unchanged = True
+            return draft_record, draft_pid
 
         if not timestamp or draft_record.updated < timestamp:
             # do not overwrite files (different bucket etc
@@ -655,15 +1346,31 @@ class RecordsDraft(object):
         _state = RecordsDraftState(app)
         app.extensions['oarepo-draft'] = _state
         app_loaded.connect(_state.app_loaded)
+        self.init_indexing_queue(app)
+
+    def init_indexing_queue(self, app):
+        if not event.contains(db.session, 'after_commit', session_after_commit):
+            event.listen(db.session, 'after_commit', session_after_commit)
+            event.listen(db.session, 'after_transaction_end', session_after_transaction_end)
+        app.after_request(flush_indexing_queue)
+        app.teardown_request(flush_indexing_queue)
 
     def init_config(self, app):
+        for k in dir(config):
+            if k.startswith('OAREPO_DRAFT_'):
+                app.config.setdefault(k, getattr(config, k))
         app.config.setdefault('RECORDS_DRAFT_ENDPOINTS', {})
         app.config['RECORDS_REST_ENDPOINTS'] = Endpoints(app, app.config.get('RECORDS_REST_ENDPOINTS', {}))
 
 
 @file_copied.connect
 def replace_urls(sender, source_record=None, target_record=None,
-                 object_version=None, tags=None, metadata=None, **kwargs):
+                 object_version=None, tags=None, metadata=None, url_rewriter=None, **kwargs):
+    if url_rewriter:
+        url_rewriter.rewrite(tags)
+        url_rewriter.rewrite(metadata)
+        return True
+
     if hasattr(source_record, 'canonical_url') and hasattr(target_record, 'canonical_url'):
         draft_url = source_record.canonical_url
         published_url = target_record.canonical_url
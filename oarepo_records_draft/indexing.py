@@ -0,0 +1,613 @@
+import datetime
+import json
+import logging
+import traceback
+from collections import namedtuple, OrderedDict
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import streaming_bulk, parallel_bulk
+from flask import current_app, g, has_request_context
+from invenio_db import db
+from invenio_indexer.api import RecordIndexer
+from invenio_indexer.proxies import current_record_to_index
+from invenio_indexer.utils import _es7_expand_action
+from invenio_search import current_search_client
+from sqlalchemy import or_
+
+from oarepo_records_draft.models import DraftIndexingOutbox
+from oarepo_records_draft.proxies import current_drafts
+
+logger = logging.getLogger(__name__)
+
+REFRESH_NONE = 'none'
+REFRESH_WAIT_FOR = 'wait_for'
+REFRESH = 'refresh'
+REFRESH_FLUSH = 'refresh+flush'
+
+REFRESH_POLICIES = (REFRESH_NONE, REFRESH_WAIT_FOR, REFRESH, REFRESH_FLUSH)
+
+IndexingResult = namedtuple('IndexingResult', 'op_type index id ok item')
+"""
+Result of a single bulk operation.
+
+:param op_type: ``index`` or ``delete``
+:param index:   name of the elasticsearch index
+:param id:      id of the elasticsearch document (record uuid)
+:param ok:      True if the operation succeeded. Deleting a document that is not in the index succeeds.
+:param item:    the bulk response item
+"""
+
+
+def get_refresh_policy(published, refresh_policy=None):
+    """
+    Returns the refresh policy for draft/published indices.
+
+    :param published:       True if the policy for published indices should be returned
+    :param refresh_policy:  an explicit policy that overrides the configured one
+    """
+    if not refresh_policy:
+        refresh_policy = current_app.config['OAREPO_DRAFT_REFRESH_POLICY']
+        if isinstance(refresh_policy, dict):
+            refresh_policy = refresh_policy['published' if published else 'draft']
+    if refresh_policy not in REFRESH_POLICIES:
+        raise ValueError('Unknown refresh policy %s, expecting one of %s' % (refresh_policy, REFRESH_POLICIES))
+    return refresh_policy
+
+
+def refresh_indices(indices):
+    """
+    Refreshes/flushes indices according to their refresh policies.
+
+    :param indices: a dictionary index name => refresh policy
+    """
+    for index, refresh_policy in indices.items():
+        if not index:
+            continue
+        if refresh_policy in (REFRESH, REFRESH_FLUSH):
+            current_search_client.indices.refresh(index=index)
+        if refresh_policy == REFRESH_FLUSH:
+            current_search_client.indices.flush(index=index)
+
+
+def record_index(indexer, record):
+    """
+    Returns (index alias, doc type) of the record. Uses the precomputed routing table
+    unless the indexer uses its own ``record_to_index``.
+    """
+    if getattr(type(indexer), 'record_to_index', None) is getattr(RecordIndexer, 'record_to_index', None) and \
+            getattr(indexer, '_record_to_index', None) is current_record_to_index:
+        route = current_drafts.index_route(record)
+        if route is not None:
+            return route.alias, route.doc_type
+    index, doc_type = indexer.record_to_index(record)
+    if not index:
+        return None, doc_type
+    return indexer._prepare_index(index, doc_type)
+
+
+def index_action(indexer, record):
+    """
+    Builds an elasticsearch bulk "index" action for an already loaded record.
+
+    This is the in-memory counterpart of ``RecordIndexer._index_action``, which
+    loads the record from the database again.
+    """
+    index, doc_type = record_index(indexer, record)
+    arguments = {}
+    body = indexer._prepare_record(record, index, doc_type, arguments)
+    action = {
+        '_op_type': 'index',
+        '_index': index,
+        '_type': doc_type,
+        '_id': str(record.id),
+        '_version': record.revision_id,
+        '_version_type': indexer._version_type,
+        '_source': body
+    }
+    action.update(arguments)
+    return action
+
+
+def delete_action(indexer, record):
+    """
+    Builds an elasticsearch bulk "delete" action for a record.
+    """
+    index, doc_type = record_index(indexer, record)
+    return {
+        '_op_type': 'delete',
+        '_index': index,
+        '_type': doc_type,
+        '_id': str(record.id)
+    }
+
+
+Operation = namedtuple('Operation', 'op_type indexer payload record_context pid_type published')
+
+
+class IndexingOperations:
+    """
+    Index/delete operations collected during a draft action. The operations
+    are sent to elasticsearch in a single bulk request in ``execute``.
+
+    Delete actions are computed immediately (the record might be deleted from the database
+    before the operations are executed), index actions are computed in ``execute``
+    so that the indexed document contains the final revision of the record.
+
+    If ``OAREPO_DRAFT_INDEXING_OUTBOX`` is set, operations on draft-managed records are not
+    sent to elasticsearch but written to the outbox table in the current transaction.
+
+    Within a request (and ``OAREPO_DRAFT_INDEXING_QUEUE`` set), the operations are passed
+    to the request's ``IndexingQueue`` and sent after the database transaction is committed.
+    """
+
+    def __init__(self, refresh_policy=None):
+        """
+        :param refresh_policy: refresh policy overriding the configured one
+        """
+        self.refresh_policy = refresh_policy
+        self.operations = []
+        self.indices = {}
+
+    def index(self, record, record_context=None):
+        """
+        Schedules indexing of the record.
+
+        :param record:          the record to be indexed
+        :param record_context:  if set, ``indexing_result`` of the context is filled in ``execute``
+        """
+        indexer = current_drafts.indexer_for_record(record)
+        if indexer and record_index(indexer, record)[0]:
+            self._add_operation('index', indexer, record, record_context, record)
+
+    def delete(self, record, record_context=None):
+        """
+        Schedules removal of the record from the index.
+
+        :param record:          the record to be removed
+        :param record_context:  if set, ``indexing_result`` of the context is filled in ``execute``
+        """
+        indexer = current_drafts.indexer_for_record(record)
+        if indexer and record_index(indexer, record)[0]:
+            self._add_operation('delete', indexer, delete_action(indexer, record), record_context, record)
+
+    def _add_operation(self, op_type, indexer, payload, record_context, record):
+        endpoint = current_drafts.endpoint_for_record(record)
+        published = endpoint.published if endpoint else True
+        self.operations.append(Operation(
+            op_type=op_type, indexer=indexer, payload=payload, record_context=record_context,
+            pid_type=endpoint.pid_type if endpoint else None, published=published))
+        self.indices[current_drafts.index_for_record(record)] = get_refresh_policy(
+            published, self.refresh_policy)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def actions(self):
+        for operation in self.operations:
+            if operation.op_type == 'index':
+                yield index_action(operation.indexer, operation.payload)
+            else:
+                yield operation.payload
+
+    def prepare(self):
+        """
+        Called within the database transaction that modifies the records. Writes the operations
+        to the outbox (if ``OAREPO_DRAFT_INDEXING_OUTBOX`` is set) and passes them to the request's
+        ``IndexingQueue``, so that they are released only if the transaction is committed. Operations
+        that remain (outside of a request or with the queue disabled) are sent by ``execute``,
+        which should be called after the transaction has been committed.
+        """
+        if current_app.config['OAREPO_DRAFT_INDEXING_OUTBOX']:
+            self._write_to_outbox()
+        queue = get_indexing_queue(create=True)
+        if queue is not None and self.operations:
+            queue.add(self)
+            self.operations = []
+            self.indices = {}
+
+    def execute(self, use_queue=True, **kwargs):
+        """
+        Sends all collected operations in one bulk request and refreshes
+        the affected indices according to their refresh policies.
+
+        :param use_queue: if False, the operations are sent immediately even within a request
+        :param kwargs: extra arguments passed to ``elasticsearch.helpers.streaming_bulk``
+                       (or ``parallel_bulk``, see ``OAREPO_DRAFT_INDEXING_THREADS``)
+        :return: a list of ``IndexingResult``, one for each operation sent to elasticsearch,
+                 in the order of operations. Operations written to the outbox or passed to the
+                 request's queue are not included - ``indexing_result`` of their record contexts
+                 is filled when the queue is flushed at the end of the request (or never
+                 for the outbox).
+        """
+        if current_app.config['OAREPO_DRAFT_INDEXING_OUTBOX']:
+            self._write_to_outbox()
+        if not self.operations:
+            return []
+        if use_queue:
+            queue = get_indexing_queue(create=True)
+            if queue is not None:
+                queue.add(self)
+                return []
+        if REFRESH_WAIT_FOR in self.indices.values():
+            kwargs.setdefault('refresh', 'wait_for')
+        results = []
+        # both streaming_bulk and parallel_bulk return the results in the same order as the actions
+        for operation, (ok, item) in zip(self.operations, self._bulk(**kwargs)):
+            op_type, item_data = next(iter(item.items()))
+            if not ok and op_type == 'delete' and item_data.get('status') == 404:
+                ok = True
+            if not ok:
+                logger.error('Error indexing record: %s', item)
+            result = IndexingResult(op_type=op_type, index=item_data.get('_index'),
+                                    id=item_data.get('_id'), ok=ok, item=item)
+            if operation.record_context is not None:
+                operation.record_context.indexing_result = result
+            results.append(result)
+        refresh_indices(self.indices)
+        return results
+
+    def _bulk(self, **kwargs):
+        """
+        Sends the operations to elasticsearch. Large sets of operations are split into chunks
+        that are sent concurrently from ``OAREPO_DRAFT_INDEXING_THREADS`` threads. The documents
+        are always serialized in the calling thread as serialization needs the application
+        context and the database session.
+        """
+        thread_count = current_app.config['OAREPO_DRAFT_INDEXING_THREADS']
+        chunk_size = kwargs.pop('chunk_size', current_app.config['OAREPO_DRAFT_INDEXING_CHUNK_SIZE'])
+        if thread_count > 1 and len(self.operations) > chunk_size:
+            return parallel_bulk(
+                current_search_client._get_current_object(),
+                list(self.actions()),
+                thread_count=thread_count,
+                chunk_size=chunk_size,
+                raise_on_error=False,
+                expand_action_callback=_es7_expand_action,
+                **kwargs)
+        return streaming_bulk(
+            current_search_client,
+            self.actions(),
+            chunk_size=chunk_size,
+            raise_on_error=False,
+            expand_action_callback=_es7_expand_action,
+            **kwargs)
+
+    def _write_to_outbox(self):
+        """
+        Moves operations on draft-managed records to the outbox table. Operations on other records
+        are kept and sent to elasticsearch directly.
+        """
+        remaining = []
+        for operation in self.operations:
+            if not operation.pid_type:
+                remaining.append(operation)
+                continue
+            if operation.op_type == 'index':
+                record = operation.payload
+                index, doc_type = record_index(operation.indexer, record)
+                record_uuid = record.id
+            else:
+                index, doc_type = operation.payload['_index'], operation.payload['_type']
+                record_uuid = operation.payload['_id']
+            db.session.add(DraftIndexingOutbox(
+                op_type=operation.op_type, record_uuid=record_uuid, pid_type=operation.pid_type,
+                index=index, doc_type=doc_type
+            ))
+        self.operations = remaining
+        if not remaining:
+            self.indices = {}
+
+
+def operation_key(operation):
+    """
+    Returns (index, document id) the operation is performed on.
+    """
+    if operation.op_type == 'index':
+        return current_drafts.index_for_record(operation.payload), str(operation.payload.id)
+    return operation.payload['_index'], operation.payload['_id']
+
+
+class IndexingQueue:
+    """
+    Request-scoped queue of elasticsearch operations.
+
+    Operations are keyed by (index, document id), only the last operation on a document is kept.
+    Operations added within a database transaction are released when the transaction is committed
+    (and dropped if it is rolled back). Released operations are sent in a single bulk request
+    at the end of the request.
+    """
+
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.pending_indices = {}
+        self.committed = OrderedDict()
+        self.committed_indices = {}
+
+    def add(self, operations: IndexingOperations):
+        for operation in operations.operations:
+            key = operation_key(operation)
+            self.pending.pop(key, None)
+            self.pending[key] = operation
+        self._merge_indices(self.pending_indices, operations.indices)
+
+    def transaction_committed(self):
+        for key, operation in self.pending.items():
+            self.committed.pop(key, None)
+            self.committed[key] = operation
+        self._merge_indices(self.committed_indices, self.pending_indices)
+        self.pending.clear()
+        self.pending_indices.clear()
+
+    def transaction_rolled_back(self):
+        self.pending.clear()
+        self.pending_indices.clear()
+
+    @staticmethod
+    def _merge_indices(target, source):
+        # keep the stronger of the refresh policies
+        for index, refresh_policy in source.items():
+            if REFRESH_POLICIES.index(refresh_policy) > REFRESH_POLICIES.index(target.get(index, REFRESH_NONE)):
+                target[index] = refresh_policy
+            else:
+                target.setdefault(index, refresh_policy)
+
+    def flush(self):
+        """
+        Sends committed operations to elasticsearch and fills ``indexing_result`` of their record contexts.
+        Records are reloaded from the database (one query per record class) so that the latest committed
+        state is indexed. Failed operations on draft-managed records are written to the indexing outbox
+        so that ``oarepo:drafts drain-outbox`` can retry them.
+
+        :return: a list of ``IndexingResult``
+        """
+        if not self.committed:
+            return []
+        operations = IndexingOperations()
+        operations.operations = reload_records(list(self.committed.values()))
+        operations.indices = dict(self.committed_indices)
+        self.committed.clear()
+        self.committed_indices.clear()
+        try:
+            results = operations.execute(use_queue=False)
+        except TransportError:
+            logger.exception('Elasticsearch not available, moving queued operations to the indexing outbox')
+            save_to_outbox(operations.operations)
+            return []
+        save_to_outbox([
+            operation for operation, result in zip(operations.operations, results) if not result.ok
+        ])
+        return results
+
+
+def save_to_outbox(operations):
+    """
+    Writes operations on draft-managed records to the indexing outbox in a new transaction.
+    """
+    operations = [operation for operation in operations if operation.pid_type]
+    if not operations:
+        return
+    outbox = IndexingOperations()
+    outbox.operations = operations
+    outbox._write_to_outbox()
+    db.session.commit()
+
+
+def reload_records(operations):
+    """
+    Replaces records in index operations with freshly loaded ones. Operations on records
+    that have been deleted in the meantime are dropped.
+    """
+    ids_by_class = {}
+    for operation in operations:
+        if operation.op_type == 'index':
+            ids_by_class.setdefault(type(operation.payload), []).append(operation.payload.id)
+    loaded = {}
+    for record_class, ids in ids_by_class.items():
+        for record in record_class.get_records(ids):
+            loaded[(record_class, record.id)] = record
+    ret = []
+    for operation in operations:
+        if operation.op_type == 'index':
+            record = loaded.get((type(operation.payload), operation.payload.id))
+            if record is None:
+                continue
+            operation = operation._replace(payload=record)
+        ret.append(operation)
+    return ret
+
+
+def get_indexing_queue(create=False):
+    """
+    Returns the indexing queue of the current request or None if not inside a request
+    or ``OAREPO_DRAFT_INDEXING_QUEUE`` is not set.
+
+    :param create: create the queue if it does not exist yet
+    """
+    if not has_request_context() or not current_app.config['OAREPO_DRAFT_INDEXING_QUEUE']:
+        return None
+    queue = g.get('oarepo_draft_indexing_queue')
+    if queue is None and create:
+        queue = g.oarepo_draft_indexing_queue = IndexingQueue()
+    return queue
+
+
+def session_after_commit(session):
+    transaction = session.transaction
+    if transaction is not None and transaction.parent is None:
+        session.info['oarepo_draft_committed'] = True
+
+
+def session_after_transaction_end(session, transaction):
+    if transaction.parent is not None:
+        # savepoint, wait for the top-level transaction
+        return
+    committed = session.info.pop('oarepo_draft_committed', False)
+    queue = get_indexing_queue()
+    if queue is None:
+        return
+    if committed:
+        queue.transaction_committed()
+    else:
+        queue.transaction_rolled_back()
+
+
+def flush_indexing_queue(response=None):
+    queue = get_indexing_queue()
+    if queue is not None:
+        try:
+            queue.flush()
+        except Exception:
+            logger.exception('Error sending queued elasticsearch operations')
+    return response
+
+
+def drain_outbox(batch_size=500, max_attempts=None, **kwargs):
+    """
+    Applies a batch of pending operations from the indexing outbox in a single bulk request.
+    Claimed rows are locked with ``SKIP LOCKED`` so that several drainers can run in parallel.
+    Only the last operation on a document is sent, earlier ones are just removed.
+    Failed operations are kept in the outbox and retried up to ``max_attempts`` times,
+    the delay before the next attempt doubles after each failure
+    (see ``OAREPO_DRAFT_INDEXING_OUTBOX_RETRY_DELAY``).
+
+    If elasticsearch is not available, the transaction is rolled back (no attempt is counted)
+    and ``(0, 0, [error])`` is returned, so the caller can back off and try again later.
+
+    :param batch_size:      max number of outbox rows processed
+    :param max_attempts:    rows that failed this many times are skipped,
+                            defaults to OAREPO_DRAFT_INDEXING_OUTBOX_MAX_ATTEMPTS
+    :param kwargs:          extra arguments passed to ``elasticsearch.helpers.streaming_bulk``
+    :return: a tuple (number of claimed rows, number of successfully processed rows, list of errors)
+    """
+    if max_attempts is None:
+        max_attempts = current_app.config['OAREPO_DRAFT_INDEXING_OUTBOX_MAX_ATTEMPTS']
+
+    now = datetime.datetime.utcnow()
+    rows = DraftIndexingOutbox.query.filter(
+        DraftIndexingOutbox.attempts < max_attempts,
+        or_(DraftIndexingOutbox.next_attempt.is_(None), DraftIndexingOutbox.next_attempt <= now)
+    ).order_by(DraftIndexingOutbox.id).limit(batch_size).with_for_update(skip_locked=True).all()
+    if not rows:
+        db.session.commit()
+        return 0, 0, []
+
+    # only the last operation on a document matters
+    latest = {(row.index, row.record_uuid): row for row in rows}
+    done = [row for row in rows if latest[(row.index, row.record_uuid)] is not row]
+
+    errors = []
+    actions, action_rows, indices = outbox_actions(list(latest.values()), now, done, errors)
+
+    if REFRESH_WAIT_FOR in indices.values():
+        kwargs.setdefault('refresh', 'wait_for')
+    if actions:
+        try:
+            send_outbox_actions(actions, action_rows, now, done, errors, **kwargs)
+        except TransportError as e:
+            # elasticsearch is not available, keep the rows untouched and release them
+            logger.warning('Elasticsearch not available when draining indexing outbox: %s', e)
+            db.session.rollback()
+            return 0, 0, [{'message': str(e)}]
+
+    if done:
+        DraftIndexingOutbox.query.filter(
+            DraftIndexingOutbox.id.in_([row.id for row in done])
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    try:
+        refresh_indices(indices)
+    except TransportError as e:
+        # the operations have been applied, the indices will be refreshed by elasticsearch itself
+        logger.warning('Could not refresh indices after draining indexing outbox: %s', e)
+    return len(rows), len(done), errors
+
+
+def outbox_actions(rows, now, done, errors):
+    """
+    Creates bulk actions for outbox rows. Rows of records that do not exist anymore are appended
+    to ``done``, rows whose action could not be created are marked as failed.
+
+    :return: a tuple (actions, rows of the actions, index name => refresh policy)
+    """
+    records = {}
+    uuids_by_pid_type = {}
+    for row in rows:
+        if row.op_type == 'index':
+            uuids_by_pid_type.setdefault(row.pid_type, []).append(row.record_uuid)
+    for pid_type, record_uuids in uuids_by_pid_type.items():
+        endpoint = current_drafts.endpoint_for_pid_type(pid_type)
+        for record in endpoint.record_class.get_records(record_uuids):
+            records[record.id] = record
+
+    actions = []
+    action_rows = []
+    indices = {}
+    for row in rows:
+        endpoint = current_drafts.endpoint_for_pid_type(row.pid_type)
+        try:
+            if row.op_type == 'index':
+                record = records.get(row.record_uuid)
+                if record is None:
+                    # deleted in the meantime, a later delete operation removes it from the index
+                    done.append(row)
+                    continue
+                actions.append(index_action(endpoint.indexer_class(), record))
+            else:
+                actions.append({
+                    '_op_type': 'delete',
+                    '_index': row.index,
+                    '_type': row.doc_type,
+                    '_id': str(row.record_uuid)
+                })
+        except Exception:
+            outbox_row_failed(row, traceback.format_exc(), now)
+            errors.append({'record_uuid': str(row.record_uuid), 'message': row.last_error})
+            continue
+        action_rows.append(row)
+        indices[row.index] = get_refresh_policy(endpoint.published)
+    return actions, action_rows, indices
+
+
+def send_outbox_actions(actions, action_rows, now, done, errors, **kwargs):
+    """
+    Sends the actions in a bulk request. Rows of successful actions are appended to ``done``,
+    rows of failed ones are marked as failed. Raises ``TransportError`` if elasticsearch is not available.
+    """
+    for row, (ok, item) in zip(action_rows, streaming_bulk(
+            current_search_client,
+            actions,
+            raise_on_error=False,
+            expand_action_callback=_es7_expand_action,
+            **kwargs)):
+        op_type, item_data = next(iter(item.items()))
+        if ok or (op_type == 'delete' and item_data.get('status') == 404):
+            done.append(row)
+        else:
+            outbox_row_failed(row, json.dumps(item, default=str), now)
+            errors.append(item)
+
+
+def outbox_row_failed(row, error, now):
+    row.attempts += 1
+    row.last_error = error
+    row.next_attempt = now + datetime.timedelta(
+        seconds=current_app.config['OAREPO_DRAFT_INDEXING_OUTBOX_RETRY_DELAY'] * 2 ** (row.attempts - 1))
+
+
+def requeue_outbox(max_attempts=None):
+    """
+    Makes failed outbox operations that are not retried anymore (failed ``max_attempts`` times)
+    pending again.
+
+    :return: number of requeued operations
+    """
+    if max_attempts is None:
+        max_attempts = current_app.config['OAREPO_DRAFT_INDEXING_OUTBOX_MAX_ATTEMPTS']
+    count = DraftIndexingOutbox.query.filter(
+        DraftIndexingOutbox.attempts >= max_attempts
+    ).update({
+        DraftIndexingOutbox.attempts: 0,
+        DraftIndexingOutbox.next_attempt: None
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
@@ -0,0 +1,159 @@
+import uuid
+
+from invenio_db import db
+from invenio_records.models import RecordMetadata, Timestamp
+from sqlalchemy_utils.types import UUIDType
+
+
+class DraftIndexingOutbox(db.Model, Timestamp):
+    """
+    Pending elasticsearch operation. Written in the same database transaction
+    as the record change (see ``OAREPO_DRAFT_INDEXING_OUTBOX``) and applied
+    by ``oarepo:drafts drain-outbox``.
+    """
+    __tablename__ = 'oarepo_draft_indexing_outbox'
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'),
+        primary_key=True, autoincrement=True)
+
+    op_type = db.Column(db.String(10), nullable=False)
+    """``index`` or ``delete``"""
+
+    record_uuid = db.Column(UUIDType, nullable=False)
+
+    pid_type = db.Column(db.String(6), nullable=True)
+    """pid type of the record, used to get record and indexer class when indexing"""
+
+    index = db.Column(db.String(255), nullable=False)
+
+    doc_type = db.Column(db.String(255), nullable=True)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    next_attempt = db.Column(db.DateTime, nullable=True)
+    """failed operation is not retried before this time"""
+
+    last_error = db.Column(db.Text, nullable=True)
+
+
+PUBLISH_JOB_PENDING = 'pending'
+PUBLISH_JOB_RUNNING = 'running'
+PUBLISH_JOB_COMPLETED = 'completed'
+PUBLISH_JOB_FAILED = 'failed'
+
+
+class DraftPublishJob(db.Model, Timestamp):
+    """
+    Publishing of a (possibly very large) set of collected records, performed in chunks,
+    each one in its own database transaction. ``cursor`` is moved in the same transaction
+    as the records of the chunk are published, so the job can be resumed after a crash.
+    """
+    __tablename__ = 'oarepo_draft_publish_job'
+
+    id = db.Column(UUIDType, primary_key=True, default=uuid.uuid4)
+
+    status = db.Column(db.String(10), nullable=False, default=PUBLISH_JOB_PENDING)
+
+    pid_type = db.Column(db.String(6), nullable=False)
+    """pid type of the root draft record"""
+
+    pid_value = db.Column(db.String(255), nullable=False)
+    """pid value of the root draft record"""
+
+    records = db.Column(db.JSON, nullable=False)
+    """[pid_type, pid_value] of draft records in the order they are published, root record is the last one"""
+
+    cursor = db.Column(db.Integer, nullable=False, default=0)
+    """number of already published records"""
+
+    total = db.Column(db.Integer, nullable=False)
+
+    chunk_size = db.Column(db.Integer, nullable=False)
+
+    urls = db.Column(db.JSON, nullable=True)
+    """
+    [draft url, published url] of the records, built when the job is created (usually in a request)
+    so that a worker without ``SERVER_NAME`` rewrites urls the same way as the synchronous publish
+    """
+
+    require_valid = db.Column(db.Boolean(name='require_valid'), nullable=False, default=True)
+    """if True, drafts are checked to be valid before each chunk is published"""
+
+    user_id = db.Column(db.String(255), nullable=True)
+    """id of the user who started the job via REST API, only this user can see the job's status"""
+
+    heartbeat = db.Column(db.DateTime, nullable=True)
+    """last time the running job reported progress, see ``OAREPO_DRAFT_PUBLISH_JOB_LEASE``"""
+
+    error = db.Column(db.Text, nullable=True)
+
+    @property
+    def finished(self):
+        return self.status in (PUBLISH_JOB_COMPLETED, PUBLISH_JOB_FAILED)
+
+    @property
+    def progress(self):
+        """fraction of published records, 0-1"""
+        return self.cursor / self.total if self.total else 1
+
+
+class DraftIdempotencyKey(db.Model, Timestamp):
+    """
+    Response of a draft action (publish, edit, unpublish) performed with ``Idempotency-Key`` header.
+    A repeated request with the same key gets the stored response instead of performing the action again.
+    """
+    __tablename__ = 'oarepo_draft_idempotency_key'
+
+    key = db.Column(db.String(255), primary_key=True)
+    """value of the Idempotency-Key header"""
+
+    path = db.Column(db.String(255), primary_key=True)
+    """path of the action url"""
+
+    user_id = db.Column(db.String(255), primary_key=True)
+    """id of the user who performed the action, empty string for anonymous user"""
+
+    request_hash = db.Column(db.String(64), nullable=True)
+    """sha256 of the query string and body of the request, a repeated request must have the same one"""
+
+    status_code = db.Column(db.Integer, nullable=True)
+    """status code of the response, None if the action is still being performed"""
+
+    response = db.Column(db.Text, nullable=True)
+
+    headers = db.Column(db.JSON, nullable=True)
+
+
+class DraftReindexCheckpoint(db.Model, Timestamp):
+    """
+    Progress of ``oarepo:drafts reindex --job-id`` for one pid type. Records are indexed
+    in the order of their uuids, all records with uuid lower or equal to ``last_uuid``
+    have been processed.
+    """
+    __tablename__ = 'oarepo_draft_reindex_checkpoint'
+
+    job_id = db.Column(db.String(255), primary_key=True)
+
+    pid_type = db.Column(db.String(6), primary_key=True)
+
+    last_uuid = db.Column(UUIDType, nullable=True)
+
+    processed = db.Column(db.Integer, nullable=False, default=0)
+
+    errors = db.Column(db.Integer, nullable=False, default=0)
+
+    total = db.Column(db.Integer, nullable=True)
+    """number of records to process, computed when the job is started"""
+
+    finished = db.Column(db.Boolean(name='finished'), nullable=False, default=False)
+
+    started = db.Column(db.DateTime, nullable=True)
+    """when the reindex was started, used as the lower bound of ``reindex --since-last-run``"""
+
+    since = db.Column(db.DateTime, nullable=True)
+    """if set, only records changed after this time are reindexed"""
+
+
+records_metadata_updated_index = db.Index('ix_oarepo_draft_records_metadata_updated', RecordMetadata.updated)
+"""Index on ``records_metadata.updated`` for ``reindex --since``"""
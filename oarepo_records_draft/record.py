@@ -132,7 +132,10 @@ def record_to_index(record):
     :param record: The record object.
     :returns: Tuple (index, doc_type).
     """
-    index_names = current_search.mappings.keys()
+    route = current_drafts.index_route(record)
+    if route is not None:
+        return route.index, route.doc_type
+
     schema = record.get('$schema', '')
     if isinstance(schema, dict):
         schema = schema.get('$ref', '')
@@ -141,5 +144,6 @@ def record_to_index(record):
     if endpoint:
         return endpoint.get_index(schema), '_doc'
 
+    index_names = current_search.mappings.keys()
     index = schema_to_index(schema, index_names=index_names)[0]
     return index, '_doc'
@@ -18,6 +18,18 @@ collect_records = _signals.signal('collect_records')
 
 :param  record_context: the record being published
 :param  action: CollectAction
+:return list of RecordContext instances of records that should be published. The contexts
+        might be lazy (``RecordContext(record_pid=pid)``), records of a whole level of the
+        collection are then loaded in one query.
+"""
+
+collect_records_batch = _signals.signal('collect_records_batch')
+"""Signal sent to collect all objects that should be published, called once for each level
+of the collection (breadth-first search) with all the records of the level. Use this signal
+instead of ``collect_records`` to resolve references of many records in a single query.
+
+:param  record_contexts: list of RecordContext instances of the current level
+:param  action: CollectAction
 :return list of RecordContext instances of records that should be published
 """
 
@@ -276,6 +288,9 @@ A notification send when a file from draft is bound to a published file
 :param target_record_context target_record context
 :param object_version the object version being published
 :param tags dictionary of tag name => tag value
+:param metadata file metadata (entry in ``_files``)
+:param url_rewriter ``UrlRewriter`` from urls of source records to urls of target records
+                    (all records being published/edited at once), might be None
 
 :return False if the file should be skipped, True/None if it should be included
 Can modify ``tags`` dictionary (replace urls etc)
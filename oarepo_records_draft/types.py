@@ -157,10 +157,16 @@ class DraftManagedRecords:
 
 
 class RecordContext:
-    def __init__(self, record_pid, record, **kwargs):
+    """
+    Context of a record being processed. The record might be passed directly or lazily,
+    in which case only ``record_pid`` is passed and the record is loaded on the first access
+    to ``record`` (or in bulk by ``current_drafts.load_records``).
+    """
+
+    def __init__(self, record_pid, record=None, **kwargs):
         self.record_pid = record_pid
-        self.record = record
-        # these two are filled during the record collection phase
+        self._record = record
+        # these two are filled after the record collection phase
         self.draft_record_url = None
         self.published_record_url = None
 
@@ -169,12 +175,45 @@ class RecordContext:
 
         # draft record context if this is published context
         self.draft_record_context = None
+
+        # filled after the elasticsearch bulk request, IndexingResult of the operation on this record.
+        # Within a request it is filled when the request's indexing queue is flushed
+        self.indexing_result = None
+
+        # set during publish/edit/unpublish if the paired record already had the same content
+        # as this record. In this case the paired record is neither updated nor reindexed
+        self.paired_record_unchanged = False
+
+        # UrlRewriter from urls of the records being processed to urls of their paired records,
+        # shared by all collected records, filled after the record collection phase
+        self.url_rewriter = None
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+    @property
+    def record(self):
+        if self._record is None and self.record_pid is not None:
+            self._record = self.record_class.get_record(self.record_pid.object_uuid)
+        return self._record
+
+    @record.setter
+    def record(self, value):
+        self._record = value
+
+    @property
+    def loaded(self):
+        return self._record is not None
+
+    @property
+    def record_class(self):
+        from .proxies import current_drafts
+        return current_drafts.endpoint_for_pid_type(self.record_pid.pid_type).record_class
+
     @property
     def record_uuid(self):
-        return self.record.id
+        if self._record is None:
+            return self.record_pid.object_uuid
+        return self._record.id
 
 
 class Endpoints:
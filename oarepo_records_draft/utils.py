@@ -0,0 +1,104 @@
+import copy
+
+_immutable_types = (str, int, float, bool, type(None))
+
+
+def clone_json(value):
+    """
+    Deep copy of a JSON-like value. Containers (dicts, lists, tuples) are copied,
+    immutable scalars are shared. Anything else falls back to ``copy.deepcopy``.
+
+    Much cheaper than ``copy.deepcopy`` on record metadata as it does not need
+    to keep the memo dictionary nor dispatch on ``__deepcopy__``/``__reduce__``.
+    """
+    if isinstance(value, _immutable_types):
+        return value
+    if isinstance(value, dict):
+        return {k: clone_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [clone_json(v) for v in value]
+    return copy.deepcopy(value)
+
+
+def clone_metadata(record, exclude=()):
+    """
+    Returns a copy of the record metadata that can be freely modified without affecting
+    the record. Top-level keys listed in ``exclude`` are not copied at all.
+    """
+    return {
+        k: clone_json(v) for k, v in record.items() if k not in exclude
+    }
+
+
+content_ignored_keys = ('oarepo:validity', 'oarepo:draft', '_files', '_bucket')
+"""Top-level keys that are not part of the content of the record - they differ between
+draft and published record even if the user has not changed anything"""
+
+file_ignored_keys = ('bucket', 'version_id', 'url')
+"""Keys of ``_files`` entries that are specific to the bucket the file lives in"""
+
+
+def _content(data, ignored_keys):
+    return {k: v for k, v in data.items() if k not in ignored_keys}
+
+
+def _files_content(data):
+    return {
+        f.get('key'): _content(f, file_ignored_keys) for f in (data.get('_files') or [])
+    }
+
+
+def same_content(source, target):
+    """
+    Returns True if the content of the source metadata and the target record is identical,
+    that is publishing (or editing) the source would not change the target. Files are compared
+    by key and file_id (that is, by the content of the file), not by the bucket they live in.
+    """
+    if _content(source, content_ignored_keys) != _content(target, content_ignored_keys):
+        return False
+    return _files_content(source) == _files_content(target)
+
+
+class UrlRewriter:
+    """
+    Rewrites urls of records (and anything below them, such as file urls) to urls of
+    their paired records. The table is compiled once from (source url, target url) pairs
+    and is keyed by the collection url, so rewriting a string costs a prefix check per collection,
+    regardless of the number of records.
+    """
+
+    def __init__(self, url_pairs):
+        self.tables = {}
+        for source_url, target_url in url_pairs:
+            collection_url, _, pid_value = source_url.rstrip('/').rpartition('/')
+            self.tables.setdefault(collection_url + '/', {})[pid_value] = target_url.rstrip('/')
+
+    def __bool__(self):
+        return bool(self.tables)
+
+    def rewrite_url(self, value):
+        """
+        Returns the url pointing to the paired record if ``value`` is the url of a source record
+        or starts with it followed by a ``/``, otherwise returns ``value`` unchanged.
+        """
+        for collection_url, table in self.tables.items():
+            if value.startswith(collection_url):
+                pid_value, sep, rest = value[len(collection_url):].partition('/')
+                target_url = table.get(pid_value)
+                if target_url is not None:
+                    return target_url + sep + rest
+        return value
+
+    def rewrite(self, value):
+        """
+        Rewrites all urls in a JSON-like value in place (containers) and returns the value.
+        """
+        if isinstance(value, str):
+            return self.rewrite_url(value)
+        if isinstance(value, dict):
+            for k, v in value.items():
+                value[k] = self.rewrite(v)
+        elif isinstance(value, list):
+            for idx, v in enumerate(value):
+                value[idx] = self.rewrite(v)
+        return value
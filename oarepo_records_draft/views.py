@@ -2,7 +2,7 @@ from flask import Blueprint
 
 from oarepo_records_draft.types import DraftPublishedRecordConfiguration
 from .actions.edit import EditRecordAction
-from .actions.publish import PublishRecordAction
+from .actions.publish import PublishRecordAction, PublishRecordsAction, PublishJobStatusAction
 from .actions.unpublish import UnpublishRecordAction
 
 
@@ -35,6 +35,16 @@ def register_blueprint(app, current_drafts):
                 )
             }
         )
+        register_blueprint_actions(
+            blueprint,
+            endpoint.draft.rest['list_route'].rstrip('/'),
+            {
+                '_publish': PublishRecordsAction.as_view(
+                    PublishRecordsAction.view_name.format(endpoint.draft.rest_name),
+                    endpoint=endpoint.draft
+                )
+            }
+        )
 
         register_blueprint_actions(
             blueprint,
@@ -56,4 +66,8 @@ def register_blueprint(app, current_drafts):
             }
         )
 
+    blueprint.add_url_rule(
+        rule='/draft-publish-jobs/<uuid:job_id>',
+        view_func=PublishJobStatusAction.as_view(PublishJobStatusAction.view_name))
+
     app.register_blueprint(blueprint)
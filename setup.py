@@ -60,6 +60,12 @@ setup(
         'invenio_config.module': [
             'oarepo_records_draft = oarepo_records_draft.config',
         ],
+        'invenio_db.models': [
+            'oarepo_records_draft = oarepo_records_draft.models',
+        ],
+        'invenio_db.alembic': [
+            'oarepo_records_draft = oarepo_records_draft:alembic',
+        ],
         'invenio_base.api_apps': [
             'oarepo_records_draft = oarepo_records_draft.ext:RecordsDraft',
         ],
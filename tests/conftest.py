@@ -33,12 +33,13 @@ from invenio_search.cli import destroy, init
 from oarepo_validate.ext import OARepoValidate
 from sqlalchemy_continuum import make_versioned
 
+from oarepo_records_draft import indexing
 from oarepo_records_draft.ext import RecordsDraft
 from oarepo_records_draft.record import DraftRecordMixin
 from sample.ext import SampleExt
 from sample.record import SampleRecord, SampleDraftRecord
 from sqlalchemy_utils import create_database, database_exists
-from tests.helpers import set_identity
+from tests.helpers import set_identity, SearchClient, bulk_result
 
 
 class JsonClient(FlaskClient):
@@ -243,6 +244,23 @@ def prepare_es(app, db):
     assert result.exit_code == 0
 
 
+@pytest.fixture()
+def search_client(monkeypatch):
+    """
+    Bulk requests and refreshes of the indexing module go to a ``SearchClient`` instead of elasticsearch,
+    all bulk operations succeed.
+    """
+    client = SearchClient()
+
+    def streaming_bulk(es, actions, **kwargs):
+        client.bulk_kwargs.append(kwargs)
+        return bulk_result(True, 200)(es, actions)
+
+    monkeypatch.setattr(indexing, 'current_search_client', client)
+    monkeypatch.setattr(indexing, 'streaming_bulk', streaming_bulk)
+    return client
+
+
 @pytest.fixture()
 def published_record(app, db, prepare_es):
     # let's create a record
@@ -124,3 +124,32 @@ def remove_ts(d):
         else:
             remove_ts(v)
     return d
+
+
+def bulk_result(ok, status):
+    """
+    Returns a replacement of ``streaming_bulk`` reporting the given result for each action
+    """
+
+    def streaming_bulk(client, actions, **kwargs):
+        for action in actions:
+            yield ok, {action['_op_type']: {'_id': action['_id'], 'status': status}}
+
+    return streaming_bulk
+
+
+class SearchClient:
+    """
+    Replacement of the elasticsearch client used by the indexing module, records refresh and flush calls
+    """
+
+    def __init__(self):
+        self.indices = self
+        self.calls = []
+        self.bulk_kwargs = []
+
+    def refresh(self, index):
+        self.calls.append(('refresh', index))
+
+    def flush(self, index):
+        self.calls.append(('flush', index))
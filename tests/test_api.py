@@ -0,0 +1,392 @@
+import datetime
+import uuid
+from io import BytesIO
+
+import pytest
+from invenio_db import db
+from invenio_files_rest.models import ObjectVersionTag
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.api import Record
+from invenio_records.models import RecordMetadata
+from sample.record import SampleDraftRecord, SampleRecord
+from sqlalchemy import event
+from sqlalchemy_continuum import version_class
+
+from oarepo_records_draft.exceptions import RecordLockedException
+from oarepo_records_draft.indexing import get_indexing_queue
+from oarepo_records_draft.models import DraftPublishJob, PUBLISH_JOB_COMPLETED, PUBLISH_JOB_FAILED, \
+    PUBLISH_JOB_PENDING, PUBLISH_JOB_RUNNING
+from oarepo_records_draft.proxies import current_drafts
+from oarepo_records_draft.signals import collect_records, collect_records_batch, CollectAction
+from oarepo_records_draft.types import RecordContext
+
+
+def test_last_live_revision_without_files(app, db):
+    # plain record without a bucket, the model is not touched by copying files
+    rec = Record.create({'title': 'first'})
+    db.session.commit()
+    rec['title'] = 'second'
+    rec.commit()
+    db.session.commit()
+    rec.delete()
+    db.session.commit()
+
+    deleted = Record.get_record(rec.id, with_deleted=True)
+    assert deleted.model.json is None
+
+    restored = current_drafts._last_live_revision(deleted)
+    assert restored['title'] == 'second'
+    assert restored.model.json == {'title': 'second'}
+
+    # does not raise MissingModelError
+    restored.commit()
+    db.session.commit()
+
+    assert Record.get_record(rec.id)['title'] == 'second'
+
+
+def test_last_live_revision_loads_one_row(app, db):
+    rec = Record.create({'title': 'rev 0'})
+    db.session.commit()
+    for rev in range(1, 5):
+        rec['title'] = f'rev {rev}'
+        rec.commit()
+        db.session.commit()
+    rec.delete()
+    db.session.commit()
+
+    deleted = Record.get_record(rec.id, with_deleted=True)
+    version_cls = version_class(RecordMetadata)
+    loaded = []
+
+    def on_load(target, context):
+        loaded.append(target.transaction_id)
+
+    event.listen(version_cls, 'load', on_load)
+    try:
+        restored = current_drafts._last_live_revision(deleted)
+    finally:
+        event.remove(version_cls, 'load', on_load)
+
+    assert restored['title'] == 'rev 4'
+    assert len(loaded) == 1
+
+
+def test_batch_deletes_all_pids_of_object(app, db):
+    object_uuid = uuid.uuid4()
+    recid = PersistentIdentifier.create('recid', '1', object_type='rec', object_uuid=object_uuid,
+                                        status=PIDStatus.REGISTERED)
+    PersistentIdentifier.create('oai', 'oai:1', object_type='rec', object_uuid=object_uuid,
+                                status=PIDStatus.REGISTERED)
+    db.session.commit()
+
+    with current_drafts.batch() as batch:
+        batch.delete_pids([recid])
+        # deletion is deferred until the batch exits
+        assert PersistentIdentifier.get('oai', 'oai:1').status == PIDStatus.REGISTERED
+
+        # resolving one pid of the object applies the deletion to that pid only ...
+        batch.apply_deleted_pid(recid)
+        assert recid.status == PIDStatus.DELETED
+
+        # ... the caller might register it again (for example, publishing after unpublish)
+        recid.status = PIDStatus.REGISTERED
+        batch.apply_deleted_pid(recid)
+        assert recid.status == PIDStatus.REGISTERED
+    db.session.commit()
+
+    # the other pids of the object are still deleted when the batch exits
+    assert PersistentIdentifier.get('recid', '1').status == PIDStatus.REGISTERED
+    assert PersistentIdentifier.get('oai', 'oai:1').status == PIDStatus.DELETED
+
+
+def test_batch_publish(app, db, draft_record):
+    with current_drafts.batch() as batch:
+        current_drafts.publish(draft_record, PersistentIdentifier.get('drecid', '1'), require_valid=False)
+        # elasticsearch operations and pid deletion are deferred
+        assert len(batch.operations) == 2
+        assert PersistentIdentifier.get('drecid', '1').status == PIDStatus.REGISTERED
+    db.session.commit()
+
+    assert len(batch.operations) == 0
+    assert PersistentIdentifier.get('drecid', '1').status == PIDStatus.DELETED
+    assert PersistentIdentifier.get('recid', '1').status == PIDStatus.REGISTERED
+
+
+def create_draft(pid_value, title='longer title'):
+    draft_uuid = uuid.uuid4()
+    pid = PersistentIdentifier.create(
+        pid_type='drecid', pid_value=pid_value, status=PIDStatus.REGISTERED,
+        object_type='rec', object_uuid=draft_uuid
+    )
+    record = SampleDraftRecord.create({
+        'title': title,
+        '$schema': SampleDraftRecord.PREFERRED_SCHEMA,
+        'id': pid_value
+    }, id_=draft_uuid)
+    return RecordContext(record=record, record_pid=pid)
+
+
+def modify_concurrently(db, record):
+    # simulates a change committed by another transaction after the record has been loaded
+    db.session.execute(RecordMetadata.__table__.update().where(
+        RecordMetadata.id == record.id
+    ).values(version_id=RecordMetadata.version_id + 1))
+
+
+def test_lock_records(app, db, files_location):
+    SampleDraftRecord._prepare_schemas()
+    first = create_draft('1')
+    second = create_draft('2')
+    db.session.commit()
+
+    current_drafts.lock_records([second, first])
+
+    modify_concurrently(db, second.record)
+    with pytest.raises(RecordLockedException):
+        current_drafts.lock_records([first, second])
+    assert current_drafts._lock_records([first, second]) == {second.record.id}
+
+
+def test_publish_many_reports_locked_records(app, db, prepare_es):
+    SampleDraftRecord._prepare_schemas()
+    first = create_draft('1')
+    second = create_draft('2')
+    db.session.commit()
+
+    modify_concurrently(db, first.record)
+    results = current_drafts.publish_many([first, second])
+    db.session.commit()
+
+    assert not results[0].ok
+    assert isinstance(results[0].error, RecordLockedException)
+    assert results[1].ok
+
+    assert PersistentIdentifier.get('drecid', '1').status == PIDStatus.REGISTERED
+    assert PersistentIdentifier.get('recid', '2').status == PIDStatus.REGISTERED
+
+
+def test_publish_chunked_resume(app, db, prepare_es):
+    SampleDraftRecord._prepare_schemas()
+    root = create_draft('1')
+    children = [create_draft('2'), create_draft('3')]
+    db.session.commit()
+
+    def collect_children(sender, record_context=None, **kwargs):
+        if record_context.record_pid.pid_value == '1':
+            return [RecordContext(record_pid=child.record_pid) for child in children]
+
+    with collect_records.connected_to(collect_children):
+        job = current_drafts.publish_chunked(root, chunk_size=1, run=False)
+    assert job.status == PUBLISH_JOB_PENDING
+    assert job.records == [['drecid', '3'], ['drecid', '2'], ['drecid', '1']]
+    assert job.require_valid
+
+    # the draft becomes invalid before the job is run
+    invalid = SampleDraftRecord.get_record(children[0].record.id)
+    invalid['title'] = 'abc'
+    invalid.commit()
+    db.session.commit()
+
+    current_drafts.run_publish_job(job)
+    assert job.status == PUBLISH_JOB_FAILED
+    assert job.cursor == 1
+    assert 'invalid' in job.error
+    assert PersistentIdentifier.get('recid', '3').status == PIDStatus.REGISTERED
+    assert PersistentIdentifier.get('drecid', '2').status == PIDStatus.REGISTERED
+    assert PersistentIdentifier.get('drecid', '1').status == PIDStatus.REGISTERED
+
+    # fix the draft and resume the job from the failed chunk
+    invalid = SampleDraftRecord.get_record(children[0].record.id)
+    invalid['title'] = 'longer title'
+    invalid.commit()
+    db.session.commit()
+
+    current_drafts.run_publish_job(job)
+    assert job.status == PUBLISH_JOB_COMPLETED
+    assert job.cursor == 3
+    assert job.progress == 1
+    for pid_value in ('1', '2', '3'):
+        assert PersistentIdentifier.get('recid', pid_value).status == PIDStatus.REGISTERED
+        assert PersistentIdentifier.get('drecid', pid_value).status == PIDStatus.DELETED
+
+
+def test_claim_publish_job(app, db):
+    app.config['OAREPO_DRAFT_PUBLISH_JOB_LEASE'] = 60
+    now = datetime.datetime.utcnow()
+    live = DraftPublishJob(status=PUBLISH_JOB_RUNNING, pid_type='drecid', pid_value='1', records=[],
+                           total=0, chunk_size=1, heartbeat=now)
+    abandoned = DraftPublishJob(status=PUBLISH_JOB_RUNNING, pid_type='drecid', pid_value='2', records=[],
+                                total=0, chunk_size=1, heartbeat=now - datetime.timedelta(seconds=120))
+    failed = DraftPublishJob(status=PUBLISH_JOB_FAILED, pid_type='drecid', pid_value='3', records=[],
+                             total=0, chunk_size=1, heartbeat=now - datetime.timedelta(seconds=120))
+    db.session.add_all([live, abandoned, failed])
+    db.session.commit()
+
+    # job of a live worker is never claimed, failed jobs only when resuming
+    claimed = current_drafts.claim_publish_job()
+    assert claimed.id == abandoned.id
+    assert claimed.status == PUBLISH_JOB_RUNNING
+    assert claimed.heartbeat > now
+    assert current_drafts.claim_publish_job() is None
+    assert current_drafts.claim_publish_job(live.id, resume_failed=True) is None
+    assert current_drafts.claim_publish_job(failed.id, resume_failed=True).id == failed.id
+
+
+def create_draft_with_file(pid_value, title='longer title'):
+    draft_uuid = uuid.uuid4()
+    pid = PersistentIdentifier.create(
+        pid_type='drecid', pid_value=pid_value, status=PIDStatus.REGISTERED,
+        object_type='rec', object_uuid=draft_uuid
+    )
+    record = SampleDraftRecord.create({
+        'title': title,
+        '$schema': SampleDraftRecord.PREFERRED_SCHEMA,
+        'control_number': pid_value
+    }, id_=draft_uuid)
+    record.files['test.txt'] = BytesIO(b'test')
+    ObjectVersionTag.create(record.files['test.txt'].obj, 'color', 'blue')
+    record.commit()
+    db.session.commit()
+    return RecordContext(record=record, record_pid=pid)
+
+
+def indexed_ids(results):
+    return [result.id for result in results if result.op_type == 'index']
+
+
+def file_tags(record):
+    return {tag.key: tag.value for tag in record.files['test.txt'].obj.tags}
+
+
+def test_publish_unchanged_record(app, db, files_location, search_client):
+    SampleDraftRecord._prepare_schemas()
+    draft = create_draft_with_file('1')
+    published = current_drafts.publish(draft, require_valid=False)[0].published_context
+    db.session.commit()
+    get_indexing_queue().flush()
+
+    # the first edit resurrects the deleted draft, the second one finds it unchanged
+    current_drafts.edit(published)
+    db.session.commit()
+    get_indexing_queue().flush()
+    draft_record = SampleDraftRecord.get_record(draft.record.id)
+    draft_revision = draft_record.revision_id
+
+    result = current_drafts.edit(published)
+    db.session.commit()
+    assert result[0].published_context.paired_record_unchanged
+    assert SampleDraftRecord.get_record(draft.record.id).revision_id == draft_revision
+    assert str(draft.record.id) not in indexed_ids(get_indexing_queue().flush())
+
+    # publishing the unchanged draft neither commits nor reindexes the published record
+    published_revision = SampleRecord.get_record(published.record.id).revision_id
+    result = current_drafts.publish(RecordContext(record=draft_record, record_pid=draft.record_pid),
+                                    require_valid=False)
+    db.session.commit()
+    assert result[0].draft_context.paired_record_unchanged
+    assert SampleRecord.get_record(published.record.id).revision_id == published_revision
+    assert str(published.record.id) not in indexed_ids(get_indexing_queue().flush())
+
+
+def test_publish_changed_record(app, db, files_location, search_client):
+    SampleDraftRecord._prepare_schemas()
+    draft = create_draft_with_file('1')
+    published = current_drafts.publish(draft, require_valid=False)[0].published_context
+    db.session.commit()
+    current_drafts.edit(published)
+    db.session.commit()
+    get_indexing_queue().flush()
+
+    draft_record = SampleDraftRecord.get_record(draft.record.id)
+    draft_record['title'] = 'changed title'
+    draft_record.commit()
+    db.session.commit()
+
+    published_revision = SampleRecord.get_record(published.record.id).revision_id
+    result = current_drafts.publish(RecordContext(record=draft_record, record_pid=draft.record_pid),
+                                    require_valid=False)
+    db.session.commit()
+    assert not result[0].draft_context.paired_record_unchanged
+    published_record = SampleRecord.get_record(published.record.id)
+    assert published_record['title'] == 'changed title'
+    assert published_record.revision_id > published_revision
+    assert str(published.record.id) in indexed_ids(get_indexing_queue().flush())
+
+
+def test_publish_changed_file_tag(app, db, files_location, search_client):
+    SampleDraftRecord._prepare_schemas()
+    draft = create_draft_with_file('1')
+    published = current_drafts.publish(draft, require_valid=False)[0].published_context
+    db.session.commit()
+    current_drafts.edit(published)
+    db.session.commit()
+    get_indexing_queue().flush()
+
+    # only a tag of the file changes, the metadata stay the same
+    draft_record = SampleDraftRecord.get_record(draft.record.id)
+    assert file_tags(draft_record) == {'color': 'blue'}
+    ObjectVersionTag.create_or_update(draft_record.files['test.txt'].obj, 'color', 'red')
+    db.session.commit()
+
+    result = current_drafts.publish(RecordContext(record=draft_record, record_pid=draft.record_pid),
+                                    require_valid=False)
+    db.session.commit()
+    assert not result[0].draft_context.paired_record_unchanged
+    assert file_tags(SampleRecord.get_record(published.record.id)) == {'color': 'red'}
+    assert str(published.record.id) in indexed_ids(get_indexing_queue().flush())
+
+
+def test_collect_records_order(app, db, files_location):
+    SampleDraftRecord._prepare_schemas()
+    drafts = {pid_value: create_draft(pid_value) for pid_value in '12345'}
+    references = {'1': '23', '2': '4', '3': '52', '4': '1'}
+
+    def collect_references(sender, record_context=None, **kwargs):
+        return [RecordContext(record_pid=drafts[ref].record_pid)
+                for ref in references.get(record_context.record_pid.pid_value, '')]
+
+    with collect_records.connected_to(collect_references):
+        collected = current_drafts.collect_records_for_action(drafts['1'], CollectAction.PUBLISH)
+
+    # breadth first, each record once
+    assert [rc.record_pid.pid_value for rc in collected] == ['1', '2', '3', '4', '5']
+    assert [rc.record['title'] for rc in collected] == ['longer title'] * 5
+
+
+def test_collect_records_batch(app, db, files_location):
+    SampleDraftRecord._prepare_schemas()
+    drafts = {pid_value: create_draft(pid_value) for pid_value in '1234'}
+    references = {'1': '23', '2': '4', '3': '4'}
+    calls = []
+
+    def collect_references(sender, record_contexts=None, action=None, **kwargs):
+        pid_values = [rc.record_pid.pid_value for rc in record_contexts]
+        calls.append(pid_values)
+        # contexts of the whole level are already loaded
+        assert all(rc.loaded for rc in record_contexts)
+        return [RecordContext(record_pid=drafts[ref].record_pid)
+                for pid_value in pid_values for ref in references.get(pid_value, '')]
+
+    with collect_records_batch.connected_to(collect_references):
+        collected = current_drafts.collect_records_for_action(drafts['1'], CollectAction.PUBLISH)
+
+    # the receiver gets all records of a level in a single call
+    assert calls == [['1'], ['2', '3'], ['4']]
+    assert [rc.record_pid.pid_value for rc in collected] == ['1', '2', '3', '4']
+
+
+def test_publish_job_urls(app, db, files_location, search_client, monkeypatch):
+    SampleDraftRecord._prepare_schemas()
+    draft = create_draft_with_file('1', title='http://localhost:5000/draft/records/1/files/test.txt')
+
+    # urls are built when the job is created in the request
+    job = current_drafts.publish_chunked(draft, require_valid=False, run=False)
+    assert job.urls == [['http://localhost:5000/draft/records/1', 'http://localhost:5000/records/1']]
+
+    # the worker can not build urls (no request nor SERVER_NAME) and uses those stored in the job
+    monkeypatch.setattr(app.extensions['oarepo-draft'], '_record_urls', lambda pid_type, pid_value: None)
+    current_drafts.run_publish_job(job)
+    assert job.status == PUBLISH_JOB_COMPLETED
+    published = SampleRecord.get_record(PersistentIdentifier.get('recid', '1').object_uuid)
+    assert published['title'] == 'http://localhost:5000/records/1/files/test.txt'
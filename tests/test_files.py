@@ -1,3 +1,5 @@
+from io import BytesIO
+
 import pytest
 
 
@@ -119,3 +121,61 @@ def test_rest_attachment_authenticated(app, db, client, draft_record, test_users
     assert resp.status_code == 201
     multi_resp = resp.json
     assert multi_resp is not None
+
+
+@pytest.mark.skipif(can_import_files(), reason="Running without invenio files")
+def test_publish_copies_files(app, db, client, draft_record):
+    from invenio_files_rest.models import ObjectVersion, ObjectVersionTag
+    from invenio_pidstore.models import PersistentIdentifier
+
+    from oarepo_records_draft.proxies import current_drafts
+    from oarepo_records_draft.signals import file_copied
+    from sample.record import SampleRecord, SampleDraftRecord
+
+    draft_record.files['test.txt'] = BytesIO(b'test')
+    draft_record.files['skipped.txt'] = BytesIO(b'skipped')
+    ObjectVersionTag.create(draft_record.files['test.txt'].obj, 'url',
+                            'http://localhost:5000/draft/records/1/files/test.txt')
+    ObjectVersionTag.create(draft_record.files['test.txt'].obj, 'color', 'blue')
+    draft_record.commit()
+    db.session.commit()
+
+    def skip_file(sender, object_version=None, **kwargs):
+        return object_version.key != 'skipped.txt'
+
+    def published_versions(published_record):
+        return ObjectVersion.query.filter_by(bucket_id=published_record.bucket.id). \
+            order_by(ObjectVersion.created).all()
+
+    with file_copied.connected_to(skip_file):
+        current_drafts.publish(draft_record, PersistentIdentifier.get('drecid', '1'), require_valid=False)
+    db.session.commit()
+
+    published_record = SampleRecord.get_record(PersistentIdentifier.get('recid', '1').object_uuid)
+    assert [f['key'] for f in published_record['_files']] == ['test.txt']
+    versions = published_versions(published_record)
+    assert [(v.key, v.is_head) for v in versions] == [('test.txt', True)]
+    assert versions[0].get_tags() == {
+        'url': 'http://localhost:5000/records/1/files/test.txt',
+        'color': 'blue'
+    }
+    assert published_record.bucket.size == 4
+
+    # edit and publish again - the copied files become the new heads in the published bucket
+    current_drafts.edit(published_record, PersistentIdentifier.get('recid', '1'))
+    db.session.commit()
+    draft = SampleDraftRecord.get_record(PersistentIdentifier.get('drecid', '1').object_uuid)
+    draft['title'] = 'changed title'
+    draft.commit()
+    db.session.commit()
+
+    with file_copied.connected_to(skip_file):
+        current_drafts.publish(draft, PersistentIdentifier.get('drecid', '1'), require_valid=False)
+    db.session.commit()
+
+    published_record = SampleRecord.get_record(PersistentIdentifier.get('recid', '1').object_uuid)
+    versions = published_versions(published_record)
+    assert [(v.key, v.is_head) for v in versions] == [('test.txt', False), ('test.txt', True)]
+    assert published_record['_files'][0]['version_id'] == str(versions[1].version_id)
+    assert versions[1].get_tags()['color'] == 'blue'
+    assert published_record.bucket.size == 8
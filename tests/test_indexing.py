@@ -0,0 +1,324 @@
+import datetime
+import uuid
+
+import pytest
+from elasticsearch.exceptions import ConnectionError
+from invenio_indexer.api import RecordIndexer
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from sample.record import SampleDraftRecord
+
+from oarepo_records_draft import indexing
+from oarepo_records_draft.cli import requeue_outbox_command, routing_command
+from oarepo_records_draft.ext import IndexRoute
+from oarepo_records_draft.indexing import IndexingOperations, drain_outbox, REFRESH_NONE, get_indexing_queue, \
+    record_index, get_refresh_policy, REFRESH_WAIT_FOR, REFRESH, REFRESH_FLUSH
+from oarepo_records_draft.proxies import current_drafts
+from oarepo_records_draft.models import DraftIndexingOutbox
+from oarepo_records_draft.types import RecordContext
+from tests.helpers import bulk_result
+
+
+def create_record(pid_value='1'):
+    SampleDraftRecord._prepare_schemas()
+    return SampleDraftRecord.create({
+        'title': 'longer title',
+        '$schema': SampleDraftRecord.PREFERRED_SCHEMA,
+        'control_number': pid_value
+    })
+
+
+def create_draft(pid_value):
+    record = create_record(pid_value)
+    pid = PersistentIdentifier.create(pid_type='drecid', pid_value=pid_value, status=PIDStatus.REGISTERED,
+                                      object_type='rec', object_uuid=record.id)
+    return RecordContext(record=record, record_pid=pid)
+
+
+def add_outbox_row(db, op_type='delete'):
+    row = DraftIndexingOutbox(op_type=op_type, record_uuid=uuid.uuid4(), pid_type='drecid',
+                              index='draft-records-record-v1.0.0', doc_type='_doc')
+    db.session.add(row)
+    db.session.commit()
+    return row.id
+
+
+class CustomIndexer(RecordIndexer):
+    def record_to_index(self, record):
+        return 'custom-index', '_doc'
+
+
+def test_record_index_uses_routing_table(app, db, files_location, monkeypatch):
+    record = create_record()
+    route = current_drafts.index_route(record)
+    assert route == IndexRoute(index='draft-sample-sample-v1.0.0', doc_type='_doc',
+                               alias='test-draft-sample-sample-v1.0.0')
+
+    indexer = RecordIndexer()
+    # the same result as the indexer's own record_to_index
+    assert record_index(indexer, record) == indexer._prepare_index(*indexer.record_to_index(record))
+    assert record_index(indexer, record) == (route.alias, route.doc_type)
+
+    # the result comes from the table, record_to_index is not called
+    monkeypatch.setattr(app.extensions['oarepo-draft'], 'index_routing', {
+        (SampleDraftRecord, SampleDraftRecord.PREFERRED_SCHEMA): IndexRoute(
+            index='routed', doc_type='_doc', alias='routed-alias')
+    })
+    assert record_index(indexer, record) == ('routed-alias', '_doc')
+
+    # schemas not in the table fall back to record_to_index
+    monkeypatch.setattr(app.extensions['oarepo-draft'], 'index_routing', {})
+    assert record_index(indexer, record) == (route.alias, route.doc_type)
+
+
+def test_record_index_custom_indexer(app, db, files_location):
+    record = create_record()
+    assert current_drafts.index_route(record) is not None
+
+    # indexer with its own record_to_index does not use the routing table
+    indexer = CustomIndexer()
+    assert record_index(indexer, record) == indexer._prepare_index('custom-index', '_doc')
+
+
+def test_routing_command(app, db):
+    result = app.test_cli_runner().invoke(routing_command)
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        'sample.record.SampleDraftRecord https://localhost:5000/schemas/sample/sample-v1.0.0.json => '
+        'test-draft-sample-sample-v1.0.0 (index draft-sample-sample-v1.0.0, doc type _doc)',
+        'sample.record.SampleRecord https://localhost:5000/schemas/sample/sample-v1.0.0.json => '
+        'test-sample-sample-v1.0.0 (index sample-sample-v1.0.0, doc type _doc)',
+    ]
+
+
+def test_get_refresh_policy(app):
+    # default policy
+    assert get_refresh_policy(False) == REFRESH_FLUSH
+    assert get_refresh_policy(True) == REFRESH_FLUSH
+
+    app.config['OAREPO_DRAFT_REFRESH_POLICY'] = {'draft': REFRESH_WAIT_FOR, 'published': REFRESH}
+    assert get_refresh_policy(False) == REFRESH_WAIT_FOR
+    assert get_refresh_policy(True) == REFRESH
+
+    # explicit policy overrides the configured one
+    assert get_refresh_policy(True, REFRESH_NONE) == REFRESH_NONE
+
+    app.config['OAREPO_DRAFT_REFRESH_POLICY'] = REFRESH
+    assert get_refresh_policy(False) == REFRESH
+    assert get_refresh_policy(True) == REFRESH
+
+    with pytest.raises(ValueError):
+        get_refresh_policy(True, 'sometimes')
+    app.config['OAREPO_DRAFT_REFRESH_POLICY'] = 'sometimes'
+    with pytest.raises(ValueError):
+        get_refresh_policy(True)
+
+
+@pytest.mark.parametrize('refresh_policy, refresh_argument, calls', [
+    (REFRESH_NONE, None, []),
+    (REFRESH_WAIT_FOR, 'wait_for', []),
+    (REFRESH, None, ['refresh']),
+    (REFRESH_FLUSH, None, ['refresh', 'flush']),
+])
+def test_refresh_policy_calls(app, db, files_location, search_client, refresh_policy, refresh_argument, calls):
+    record = create_record()
+    db.session.commit()
+
+    operations = IndexingOperations(refresh_policy=refresh_policy)
+    operations.index(record)
+    results = operations.execute(use_queue=False)
+    assert [x.ok for x in results] == [True]
+    assert search_client.bulk_kwargs[0].get('refresh') == refresh_argument
+    assert search_client.calls == [(call, 'test-draft-sample-sample-v1.0.0') for call in calls]
+
+
+def test_publish_refresh_policy(app, db, files_location, search_client):
+    app.config['OAREPO_DRAFT_REFRESH_POLICY'] = {'draft': REFRESH_NONE, 'published': REFRESH}
+    first = create_draft('1')
+    second = create_draft('2')
+    db.session.commit()
+
+    # draft and published indices get their own policy
+    current_drafts.publish(first)
+    db.session.commit()
+    get_indexing_queue().flush()
+    assert search_client.calls == [('refresh', 'test-sample-sample-v1.0.0')]
+
+    # the policy of a single call overrides both of them
+    search_client.calls.clear()
+    current_drafts.publish(second, refresh_policy=REFRESH_FLUSH)
+    db.session.commit()
+    get_indexing_queue().flush()
+    assert sorted(search_client.calls) == [
+        ('flush', 'test-draft-sample-sample-v1.0.0'),
+        ('flush', 'test-sample-sample-v1.0.0'),
+        ('refresh', 'test-draft-sample-sample-v1.0.0'),
+        ('refresh', 'test-sample-sample-v1.0.0'),
+    ]
+
+
+def test_prepare_writes_outbox_in_transaction(app, db, files_location):
+    app.config['OAREPO_DRAFT_INDEXING_OUTBOX'] = True
+    record = create_record()
+    db.session.commit()
+
+    operations = IndexingOperations(refresh_policy=REFRESH_NONE)
+    operations.index(record)
+    operations.prepare()
+    # nothing left to be sent after commit
+    assert not operations.operations
+    db.session.rollback()
+    assert DraftIndexingOutbox.query.count() == 0
+
+    operations = IndexingOperations(refresh_policy=REFRESH_NONE)
+    operations.index(record)
+    operations.prepare()
+    db.session.commit()
+    assert operations.execute() == []
+    row = DraftIndexingOutbox.query.one()
+    assert row.op_type == 'index'
+    assert row.record_uuid == record.id
+
+
+def test_prepare_passes_operations_to_request_queue(app, db, files_location):
+    record = create_record()
+    db.session.commit()
+
+    with app.test_request_context():
+        operations = IndexingOperations(refresh_policy=REFRESH_NONE)
+        operations.index(record)
+        operations.prepare()
+        assert not operations.operations
+        queue = get_indexing_queue()
+        assert len(queue.pending) == 1
+
+
+def queue_delete(record, record_context=None):
+    operations = IndexingOperations(refresh_policy=REFRESH_NONE)
+    operations.delete(record, record_context)
+    assert operations.execute() == []
+
+
+def test_queue_releases_operations_on_commit(app, db, files_location):
+    record = create_record()
+    db.session.commit()
+
+    with app.test_request_context():
+        queue_delete(record)
+        queue = get_indexing_queue()
+        assert len(queue.pending) == 1
+
+        # savepoints do not release the operations
+        with db.session.begin_nested():
+            record['title'] = 'changed title'
+            record.commit()
+        assert len(queue.pending) == 1
+        assert not queue.committed
+
+        db.session.commit()
+        assert not queue.pending
+        assert len(queue.committed) == 1
+
+        # operations of a rolled back transaction are dropped
+        other = create_record()
+        queue_delete(other)
+        assert len(queue.pending) == 1
+        db.session.rollback()
+        assert not queue.pending
+        assert len(queue.committed) == 1
+
+
+def test_queue_flush_results_and_failures(app, db, files_location, monkeypatch):
+    app.config['OAREPO_DRAFT_REFRESH_POLICY'] = REFRESH_NONE
+    record = create_record()
+    db.session.commit()
+
+    with app.test_request_context():
+        record_context = RecordContext(record=record, record_pid=None)
+        queue_delete(record, record_context)
+        db.session.commit()
+
+        monkeypatch.setattr(indexing, 'streaming_bulk', bulk_result(False, 500))
+        results = get_indexing_queue().flush()
+        assert len(results) == 1
+        assert not results[0].ok
+        assert record_context.indexing_result is results[0]
+
+    # failed operation is retried via the outbox
+    row = DraftIndexingOutbox.query.one()
+    assert row.op_type == 'delete'
+    assert row.record_uuid == record.id
+    db.session.delete(row)
+    db.session.commit()
+
+    with app.test_request_context():
+        queue_delete(record)
+        db.session.commit()
+
+        def unavailable(*args, **kwargs):
+            raise ConnectionError('N/A', 'Connection refused', None)
+            yield
+
+        monkeypatch.setattr(indexing, 'streaming_bulk', unavailable)
+        assert get_indexing_queue().flush() == []
+
+    assert DraftIndexingOutbox.query.one().record_uuid == record.id
+
+
+def test_drain_outbox_elasticsearch_not_available(app, db, monkeypatch):
+    app.config['OAREPO_DRAFT_REFRESH_POLICY'] = REFRESH_NONE
+    row_id = add_outbox_row(db)
+
+    def unavailable(*args, **kwargs):
+        raise ConnectionError('N/A', 'Connection refused', None)
+        yield
+
+    monkeypatch.setattr(indexing, 'streaming_bulk', unavailable)
+    claimed, ok, errors = drain_outbox()
+    assert (claimed, ok) == (0, 0)
+    assert len(errors) == 1
+
+    # the row has been released without counting the attempt
+    row = DraftIndexingOutbox.query.get(row_id)
+    assert row.attempts == 0
+    assert row.next_attempt is None
+
+
+def test_drain_outbox_retry(app, db, monkeypatch):
+    app.config['OAREPO_DRAFT_REFRESH_POLICY'] = REFRESH_NONE
+    app.config['OAREPO_DRAFT_INDEXING_OUTBOX_MAX_ATTEMPTS'] = 2
+    row_id = add_outbox_row(db)
+
+    monkeypatch.setattr(indexing, 'streaming_bulk', bulk_result(False, 500))
+    assert drain_outbox()[:2] == (1, 0)
+    row = DraftIndexingOutbox.query.get(row_id)
+    assert row.attempts == 1
+    assert row.last_error
+    assert row.next_attempt > datetime.datetime.utcnow()
+
+    # not retried before next_attempt
+    assert drain_outbox() == (0, 0, [])
+
+    row.next_attempt = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    db.session.commit()
+    assert drain_outbox()[:2] == (1, 0)
+    row = DraftIndexingOutbox.query.get(row_id)
+    assert row.attempts == 2
+    first_delay = app.config['OAREPO_DRAFT_INDEXING_OUTBOX_RETRY_DELAY']
+    # the delay doubles with each attempt
+    assert row.next_attempt - row.updated > datetime.timedelta(seconds=first_delay * 1.5)
+
+    # attempts exhausted
+    row.next_attempt = None
+    db.session.commit()
+    assert drain_outbox() == (0, 0, [])
+
+    result = app.test_cli_runner().invoke(requeue_outbox_command)
+    assert result.exit_code == 0
+    assert 'Requeued 1 operations' in result.output
+    row = DraftIndexingOutbox.query.get(row_id)
+    assert row.attempts == 0
+
+    # missing document is fine when deleting
+    monkeypatch.setattr(indexing, 'streaming_bulk', bulk_result(False, 404))
+    assert drain_outbox() == (1, 1, [])
+    assert DraftIndexingOutbox.query.count() == 0
@@ -0,0 +1,173 @@
+import datetime
+import uuid
+
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.models import RecordMetadata
+
+from oarepo_records_draft import cli
+from oarepo_records_draft.cli import reindex_records, stream_object_uuids, get_reindex_checkpoints, gather, \
+    prepare_reindex
+from oarepo_records_draft.models import DraftReindexCheckpoint
+
+
+class BatchResult:
+    def __init__(self, ok, errors):
+        self.ok = ok
+        self.errors = errors
+
+    def get(self):
+        return self.ok, self.errors
+
+
+class QueuedBatch:
+    def __init__(self, pool, object_uuids):
+        self.pool = pool
+        self.object_uuids = object_uuids
+
+    def get(self):
+        self.pool.in_flight.remove(self)
+        return len(self.object_uuids), []
+
+
+class RecordingPool:
+    """
+    Runs nothing, records batches queued by the reindex and the maximum number of them waiting at once
+    """
+
+    def __init__(self, processes=None):
+        self.in_flight = []
+        self.queued = []
+        self.max_in_flight = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def apply_async(self, func, args=()):
+        batch = QueuedBatch(self, args[1])
+        self.in_flight.append(batch)
+        self.queued.append(args[1])
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        return batch
+
+
+def create_pids(db, count, updated=None, status=PIDStatus.REGISTERED):
+    uuids = []
+    for _ in range(count):
+        object_uuid = uuid.uuid4()
+        pid = PersistentIdentifier.create('drecid', str(object_uuid), object_type='rec', object_uuid=object_uuid,
+                                          status=PIDStatus.REGISTERED)
+        pid.status = status
+        db.session.add(RecordMetadata(id=object_uuid, json={}))
+        uuids.append(object_uuid)
+    db.session.commit()
+    if updated:
+        RecordMetadata.query.filter(RecordMetadata.id.in_(uuids)).update(
+            {RecordMetadata.updated: updated}, synchronize_session=False)
+        db.session.commit()
+    return uuids
+
+
+def test_since_and_since_last_run_exclusive(app, db):
+    result = app.test_cli_runner().invoke(reindex_records, [
+        '--since', '2021-03-01T12:00:00', '--since-last-run'
+    ])
+    assert result.exit_code == 2
+    assert '--since and --since-last-run can not be used together' in result.output
+
+
+def test_reindex_max_in_flight(app, db, monkeypatch):
+    uuids = create_pids(db, 7)
+    pools = []
+
+    def create_pool(processes=None):
+        pools.append(RecordingPool(processes))
+        return pools[-1]
+
+    monkeypatch.setattr(cli, 'Pool', create_pool)
+    result = app.test_cli_runner().invoke(reindex_records, [
+        '--pid-type', 'drecid', '--bulk-size', '2', '--max-in-flight', '2'
+    ])
+    assert result.exit_code == 0, result.output
+
+    pool = pools[0]
+    assert pool.queued == [sorted(uuids)[i:i + 2] for i in range(0, 7, 2)]
+    # a batch is gathered before the third one is queued
+    assert pool.max_in_flight == 2
+    assert pool.in_flight == []
+
+
+def test_stream_object_uuids(app, db):
+    old = create_pids(db, 4, updated=datetime.datetime(2020, 1, 1))
+    new = create_pids(db, 3)
+    create_pids(db, 2, status=PIDStatus.DELETED)
+    registered = sorted(old + new)
+
+    # pages smaller than the number of records
+    assert list(stream_object_uuids('drecid', 2)) == registered
+    assert list(stream_object_uuids('drecid', 7)) == registered
+
+    # continues after the given uuid
+    assert list(stream_object_uuids('drecid', 2, after_uuid=registered[2])) == registered[3:]
+    assert list(stream_object_uuids('drecid', 2, after_uuid=registered[-1])) == []
+
+    # only changed records
+    assert list(stream_object_uuids('drecid', 2, since=datetime.datetime(2021, 1, 1))) == sorted(new)
+    assert list(stream_object_uuids('other', 2)) == []
+
+
+def test_reindex_checkpoints(app, db):
+    create_pids(db, 5)
+    checkpoints = get_reindex_checkpoints('job', ['drecid', 'recid'], False, {})
+    assert checkpoints['drecid'].total == 5
+    assert checkpoints['recid'].total == 0
+    assert checkpoints['drecid'].started is not None
+
+    uuids = list(stream_object_uuids('drecid', 10))
+    totals = {'ok': 0, 'errors': 0, 'processed': 0}
+    start = datetime.datetime.now()
+    gather((BatchResult(2, []), 'drecid', 2, uuids[1]), checkpoints, totals, start, False)
+    gather((BatchResult(1, [{'error': 'failed'}]), 'drecid', 2, uuids[3]), checkpoints, totals, start, False)
+    assert totals == {'ok': 3, 'errors': 1, 'processed': 4}
+
+    # checkpoint is committed after each gathered batch
+    db.session.expire_all()
+    checkpoint = DraftReindexCheckpoint.query.get(('job', 'drecid'))
+    assert checkpoint.last_uuid == uuids[3]
+    assert checkpoint.processed == 4
+    assert checkpoint.errors == 1
+
+    # resuming keeps the progress and continues after the last gathered batch
+    checkpoints = get_reindex_checkpoints('job', ['drecid', 'recid'], True, {})
+    assert checkpoints['drecid'].processed == 4
+    assert list(stream_object_uuids('drecid', 10, after_uuid=checkpoints['drecid'].last_uuid)) == uuids[4:]
+
+    # restarting starts from scratch
+    checkpoints = get_reindex_checkpoints('job', ['drecid'], False, {})
+    assert checkpoints['drecid'].processed == 0
+    assert checkpoints['drecid'].last_uuid is None
+    assert DraftReindexCheckpoint.query.filter_by(job_id='job').count() == 1
+
+
+def test_prepare_reindex_since(app, db):
+    since = datetime.datetime(2021, 3, 1)
+    checkpoints, since_by_pid_type = prepare_reindex(None, ['drecid', 'recid'], False, since, False)
+    assert checkpoints == {}
+    assert since_by_pid_type == {'drecid': since, 'recid': since}
+
+    checkpoints, since_by_pid_type = prepare_reindex('job', ['drecid'], False, since, False)
+    assert checkpoints['drecid'].since == since
+    checkpoints['drecid'].finished = True
+    db.session.commit()
+
+    # resumed job keeps the time window of the interrupted run
+    checkpoints, since_by_pid_type = prepare_reindex('job', ['drecid'], True, None, False)
+    assert since_by_pid_type == {'drecid': since}
+
+    # the next run takes the start of the last finished run, pid types that never finished are reindexed fully
+    checkpoints, since_by_pid_type = prepare_reindex('next', ['drecid', 'recid'], False, None, True)
+    assert since_by_pid_type == {'drecid': checkpoints['drecid'].since}
+    assert checkpoints['drecid'].since == DraftReindexCheckpoint.query.get(('job', 'drecid')).started
+    assert checkpoints['recid'].since is None
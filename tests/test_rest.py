@@ -1,5 +1,9 @@
+import datetime
 import json
 
+from oarepo_records_draft.cli import purge_idempotency_keys_command
+from oarepo_records_draft.models import DraftIdempotencyKey, DraftPublishJob, PUBLISH_JOB_COMPLETED
+from oarepo_records_draft.proxies import current_drafts
 from tests.helpers import remove_ts
 
 
@@ -244,3 +248,214 @@ def test_draft_create(app, db, client, prepare_es, test_users):
         },
         "status": "ok"
     }
+
+
+def test_publish_many(app, db, client, prepare_es, test_users):
+    resp = client.post('/draft/records/', data=json.dumps({'title': 'longer test'}), content_type='application/json')
+    assert resp.status_code == 201
+    resp = client.post('/draft/records/', data=json.dumps({'title': 'abc'}), content_type='application/json')
+    assert resp.status_code == 201
+
+    resp = client.post('/test/login/1')
+    assert resp.status_code == 200
+
+    resp = client.post('/draft/records/_publish', data=json.dumps(['1', '2', '3']))
+    assert resp.status_code == 200
+    assert resp.json == {
+        'status': 'error',
+        'results': [
+            {
+                'pid': '1',
+                'status': 'ok',
+                'links': {
+                    'published': 'http://localhost:5000/records/1'
+                }
+            },
+            {
+                'pid': '2',
+                'status': 'error',
+                'message': 'Can not publish invalid record',
+                'errors': {
+                    'marshmallow': [{
+                        'field': 'title',
+                        'message': 'Shorter than minimum length 5.'
+                    }]
+                }
+            },
+            {
+                'pid': '3',
+                'status': 'error',
+                'message': 'Record not found'
+            }
+        ]
+    }
+
+    resp = client.get('/records/1')
+    assert resp.status_code == 200
+
+    resp = client.get('/draft/records/1')
+    assert resp.status_code == 410
+
+    resp = client.get('/records/2')
+    assert resp.status_code == 404
+
+    resp = client.get('/draft/records/2')
+    assert resp.status_code == 200
+
+
+def test_publish_idempotency_key(app, db, client, prepare_es, test_users):
+    resp = client.post('/draft/records/', data=json.dumps({'title': 'longer test'}), content_type='application/json')
+    assert resp.status_code == 201
+
+    resp = client.post('/test/login/1')
+    assert resp.status_code == 200
+
+    resp = client.post('/draft/records/1/publish', headers={'Idempotency-Key': 'abc'})
+    assert resp.status_code == 302
+    assert resp.json == {
+        "status": "ok",
+        "links": {
+            "published": "http://localhost:5000/records/1"
+        }
+    }
+
+    # repeated request returns the stored response even though the draft does not exist anymore
+    resp = client.post('/draft/records/1/publish', headers={'Idempotency-Key': 'abc'})
+    assert resp.status_code == 302
+    assert resp.headers['location'] == 'http://localhost:5000/records/1'
+    assert resp.json == {
+        "status": "ok",
+        "links": {
+            "published": "http://localhost:5000/records/1"
+        }
+    }
+
+    # without the key, the action is performed again
+    resp = client.post('/draft/records/1/publish')
+    assert resp.status_code == 410
+
+
+def test_publish_async(app, db, client, prepare_es, test_users):
+    resp = client.post('/draft/records/', data=json.dumps({'title': 'longer test'}), content_type='application/json')
+    assert resp.status_code == 201
+
+    resp = client.post('/test/login/1')
+    assert resp.status_code == 200
+
+    resp = client.post('/draft/records/1/publish?async=true')
+    assert resp.status_code == 202
+    status_url = resp.json['links']['status']
+    assert resp.headers['location'] == status_url
+    status_path = status_url[len('http://localhost:5000'):]
+
+    resp = client.get(status_path)
+    assert resp.status_code == 200
+    assert resp.json['status'] == 'pending'
+    assert resp.json['total'] == 1
+
+    # the draft is not published until a worker runs the job
+    resp = client.get('/draft/records/1')
+    assert resp.status_code == 200
+
+    # only the user who started the job can see it
+    client.post('/test/logout')
+    resp = client.get(status_path)
+    assert resp.status_code == 401
+
+    client.post('/test/login/2')
+    resp = client.get(status_path)
+    assert resp.status_code == 404
+
+    client.post('/test/logout')
+    client.post('/test/login/1')
+
+    jobs = current_drafts.run_pending_publish_jobs()
+    assert len(jobs) == 1
+    assert jobs[0].status == 'completed'
+    assert current_drafts.run_pending_publish_jobs() == []
+
+    resp = client.get(status_path)
+    assert resp.status_code == 200
+    assert resp.json['status'] == 'completed'
+    assert resp.json['progress'] == 1
+    assert resp.json['links']['published'] == 'http://localhost:5000/records/1'
+    assert 'records' not in resp.json
+
+    resp = client.get('/records/1')
+    assert resp.status_code == 200
+
+
+def test_publish_job_status_completed(app, db, client, test_users):
+    job = DraftPublishJob(
+        status=PUBLISH_JOB_COMPLETED, pid_type='drecid', pid_value='1',
+        records=[['drecid', str(x)] for x in range(1000, 0, -1)],
+        cursor=1000, total=1000, chunk_size=100, user_id='1'
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    client.post('/test/login/1')
+    resp = client.get(f'/draft-publish-jobs/{job.id}')
+    assert resp.status_code == 200
+    # the size of the response does not depend on the number of published records
+    assert resp.json == {
+        'id': str(job.id),
+        'status': 'completed',
+        'published': 1000,
+        'total': 1000,
+        'progress': 1,
+        'links': {
+            'status': f'http://localhost:5000/draft-publish-jobs/{job.id}',
+            'published': 'http://localhost:5000/records/1'
+        }
+    }
+
+
+def test_idempotency_key_mismatch_and_abandoned(app, db, client, prepare_es, test_users):
+    resp = client.post('/draft/records/', data=json.dumps({'title': 'longer test'}), content_type='application/json')
+    assert resp.status_code == 201
+    resp = client.post('/draft/records/', data=json.dumps({'title': 'another test'}), content_type='application/json')
+    assert resp.status_code == 201
+
+    resp = client.post('/test/login/1')
+    assert resp.status_code == 200
+
+    resp = client.post('/draft/records/_publish', data=json.dumps(['1']), headers={'Idempotency-Key': 'abc'})
+    assert resp.status_code == 200
+    assert resp.json['status'] == 'ok'
+
+    # the same key with a different body is rejected
+    resp = client.post('/draft/records/_publish', data=json.dumps(['2']), headers={'Idempotency-Key': 'abc'})
+    assert resp.status_code == 422
+
+    resp = client.get('/draft/records/2')
+    assert resp.status_code == 200
+
+    # a request that has not finished within the lease (killed worker) is performed again
+    db.session.add(DraftIdempotencyKey(
+        key='def', path='/draft/records/2/publish', user_id='1', request_hash=None,
+        created=datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=app.config['OAREPO_DRAFT_IDEMPOTENCY_KEY_LEASE'] + 1)))
+    db.session.commit()
+
+    resp = client.post('/draft/records/2/publish', headers={'Idempotency-Key': 'def'})
+    assert resp.status_code == 302
+
+    resp = client.get('/records/2')
+    assert resp.status_code == 200
+
+
+def test_purge_idempotency_keys(app, db):
+    expired = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=app.config['OAREPO_DRAFT_IDEMPOTENCY_KEY_TTL'] + 1)
+    for idx in range(5):
+        db.session.add(DraftIdempotencyKey(key=f'old-{idx}', path='/draft/records/1/publish', user_id='1',
+                                           status_code=302, response='', created=expired))
+    db.session.add(DraftIdempotencyKey(key='new', path='/draft/records/1/publish', user_id='1',
+                                       status_code=302, response=''))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(purge_idempotency_keys_command, ['--batch-size', '2'])
+    assert result.exit_code == 0
+    assert 'Removed 5 idempotency keys' in result.output
+    assert [x.key for x in DraftIdempotencyKey.query.all()] == ['new']
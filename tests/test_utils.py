@@ -0,0 +1,46 @@
+from oarepo_records_draft.utils import clone_metadata, clone_json, same_content, UrlRewriter
+
+
+def test_clone_json():
+    src = {'a': [1, {'b': 'c'}, (2, 3)], 'd': None}
+    cloned = clone_json(src)
+    assert cloned == {'a': [1, {'b': 'c'}, [2, 3]], 'd': None}
+    cloned['a'][1]['b'] = 'x'
+    cloned['a'].append(4)
+    assert src == {'a': [1, {'b': 'c'}, (2, 3)], 'd': None}
+
+
+def test_clone_metadata():
+    src = {'title': 'abc', 'oarepo:validity': {'valid': True}, '_files': [{'key': 'a.txt'}]}
+    cloned = clone_metadata(src, exclude=('oarepo:validity',))
+    assert cloned == {'title': 'abc', '_files': [{'key': 'a.txt'}]}
+    cloned['_files'][0]['key'] = 'b.txt'
+    assert src['_files'][0]['key'] == 'a.txt'
+
+
+def test_same_content():
+    draft = {
+        'title': 'abc', 'oarepo:validity': {'valid': True},
+        '_bucket': 'b1', '_files': [{'key': 'a.txt', 'file_id': 'f1', 'bucket': 'b1', 'version_id': 'v1'}]
+    }
+    published = {
+        'title': 'abc',
+        '_bucket': 'b2', '_files': [{'key': 'a.txt', 'file_id': 'f1', 'bucket': 'b2', 'version_id': 'v2'}]
+    }
+    assert same_content(draft, published)
+    assert not same_content(dict(draft, title='def'), published)
+    assert not same_content(dict(draft, _files=[{'key': 'a.txt', 'file_id': 'f2'}]), published)
+
+
+def test_url_rewriter():
+    rewriter = UrlRewriter([
+        ('https://localhost/api/draft/records/1', 'https://localhost/api/records/1'),
+        ('https://localhost/api/draft/records/2/', 'https://localhost/api/records/2/'),
+    ])
+    assert rewriter.rewrite_url('https://localhost/api/draft/records/1') == 'https://localhost/api/records/1'
+    assert rewriter.rewrite_url('https://localhost/api/draft/records/2/files/a.txt') == \
+        'https://localhost/api/records/2/files/a.txt'
+    assert rewriter.rewrite_url('https://localhost/api/draft/records/12') == 'https://localhost/api/draft/records/12'
+    assert rewriter.rewrite({'a': [{'url': 'https://localhost/api/draft/records/1/files/b'}], 'b': 1}) == \
+        {'a': [{'url': 'https://localhost/api/records/1/files/b'}], 'b': 1}
+    assert not UrlRewriter([])